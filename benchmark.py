@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import tensorflow as tf
+from absl import app, flags, logging
+from absl.flags import FLAGS
+from config import cfg
+from utils.data_aug import get_dataset, read_manifest, _parse_tfrecord, _train_map, RAW_SCHEMA
+from utils.inference import peak_rss_mb
+from utils.util import config_optimizer, set_mixed_precision
+from utils.loss import get_loss
+from models.model_summary import create_model
+
+flags.DEFINE_integer('steps', 100, '每种配置计时的batch数')
+flags.DEFINE_string('output', './benchmark/pipeline.json', '结果保存路径')
+flags.DEFINE_integer('train_steps', 0, '大于0时用随机batch对比 float32 与混合精度的单步训练耗时和内存, 不测数据管道')
+flags.DEFINE_string('precision', 'mixed_bfloat16', '与 float32 对比的混合精度策略, 为空时使用 cfg.TRAIN.MIXED_PRECISION')
+flags.DEFINE_boolean('compare_model', False, '同时计时当前配置的单步训练, 比较默认数据管道与模型的吞吐量, 判断数据管道是否成为瓶颈')
+flags.DEFINE_string('trace_dir', '', '不为空时用 TensorFlow Profiler 记录默认配置的迭代, 在 TensorBoard 的 input pipeline 页面查看各算子耗时')
+
+AUGMENTATIONS = ['COLOR', 'FLIP', 'SCALE_CROP', 'GRIDMASK', 'CUTMIX']
+
+
+# 当前进程的常驻内存, 非 linux 系统退化为峰值内存
+def rss_mb():
+    if not os.path.isfile('/proc/self/statm'):
+        return peak_rss_mb()
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def measure(dataset, num_steps):
+    """
+    迭代 num_steps 个元素, 第一个元素单独计时(包含管道启动和缓冲区填充)
+    :return: 吞吐量、每个元素的平均耗时和内存占用
+    """
+    rss_before = rss_mb()
+    start = time.time()
+    iterator = iter(dataset)
+    images, _ = next(iterator)
+    first = time.time() - start
+    num_elements, num_samples = 0, 0
+    start = time.time()
+    for images, _ in iterator:
+        num_elements += 1
+        num_samples += int(images.shape[0]) if images.shape.rank == 4 else 1
+        if num_elements >= num_steps:
+            break
+    elapsed = max(time.time() - start, 1e-9)
+    return {'samples_per_sec': num_samples / elapsed,
+            'ms_per_element': 1000. * elapsed / max(num_elements, 1),
+            'first_element_ms': 1000. * first,
+            'rss_mb': rss_mb(),
+            'rss_delta_mb': rss_mb() - rss_before,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def with_augmentation(base, **kwargs):
+    c = base.clone()
+    c.defrost()
+    for k, v in kwargs.items():
+        c.AUGMENTATION[k] = v
+    return c
+
+
+def augmentation_variants(base):
+    """
+    默认配置、全部关闭, 以及每种增广相对默认配置单独切换
+    """
+    variants = {'default': base, 'none': with_augmentation(base, **{k: False for k in AUGMENTATIONS})}
+    for k in AUGMENTATIONS:
+        name = ('-' if base.AUGMENTATION[k] else '+') + k.lower()
+        variants[name] = with_augmentation(base, **{k: not base.AUGMENTATION[k]})
+    return variants
+
+
+def stage_latency(base, num_steps):
+    """
+    依次计时 读取 -> 解码 -> 增广 的前缀管道(逐样本, 不batch), 相邻两级的差值即为该阶段每个样本的开销;
+    只适用于 TFRecord 数据源
+    """
+    autotune = tf.data.experimental.AUTOTUNE
+    schema = read_manifest(base.DATASET.TRAIN_DATA).get('schema', RAW_SCHEMA)
+    decode = lambda x: _parse_tfrecord(x, base, schema)
+    files = tf.data.Dataset.list_files(base.DATASET.TRAIN_DATA, shuffle=True)
+    records = files.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=schema['compression']),
+                               cycle_length=base.DATASET.CYCLE_LENGTH, num_parallel_calls=autotune).repeat()
+    stages = [
+        ('read', records.map(lambda x: (tf.strings.length(x), x))),
+        ('decode', records.map(decode, num_parallel_calls=autotune)),
+        ('augment', records.map(lambda x: _train_map((x,), base, decode), num_parallel_calls=autotune)),
+    ]
+    results, previous = {}, 0.
+    for name, dataset in stages:
+        r = measure(dataset.prefetch(autotune), num_steps * base.TRAIN.BATCH_SIZE)
+        r['stage_ms_per_sample'] = r['ms_per_element'] - previous
+        previous = r['ms_per_element']
+        results[name] = r
+        logging.info('stage %s: %.3f ms/sample', name, r['stage_ms_per_sample'])
+    return results
+
+
+def train_step_benchmark(base, policies, num_steps):
+    """
+    对每种精度策略重新创建模型和优化器, 在同一个随机batch上计时训练步
+    :return: {策略: 单步耗时和内存}
+    """
+    h, w = base.DATASET.SIZE
+    x = tf.random.uniform([base.TRAIN.BATCH_SIZE, h, w, base.DATASET.CHANNELS])
+    y = tf.cast(tf.random.uniform([base.TRAIN.BATCH_SIZE, h, w, 1]) > 0.5, tf.uint8)
+    results = {}
+    for policy in policies:
+        c = base.clone()
+        c.defrost()
+        c.TRAIN.MIXED_PRECISION = policy
+        tf.keras.backend.clear_session()
+        tf.keras.mixed_precision.experimental.set_policy('float32')
+        set_mixed_precision(c)
+        rss_before = rss_mb()
+        model = create_model(c, name=c.MODEL_NAME, backbone=c.BACKBONE_NAME)
+        loss = get_loss(c, c.LOSS.TYPE)
+        optimizer = config_optimizer(c, learning_rate=c.SCHEDULER.LR_INIT)
+        loss_scale = policy == 'mixed_float16'
+
+        @tf.function
+        def train_step(x_, y_):
+            with tf.GradientTape() as tape:
+                total_loss = loss(y_, model(x_, training=True))
+                scaled_loss = optimizer.get_scaled_loss(total_loss) if loss_scale else total_loss
+            grads = tape.gradient(scaled_loss, model.trainable_variables)
+            if loss_scale:
+                grads = optimizer.get_unscaled_gradients(grads)
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+            return total_loss
+
+        train_step(x, y).numpy()
+        start = time.time()
+        for _ in range(num_steps):
+            train_step(x, y).numpy()
+        ms_per_step = 1000. * (time.time() - start) / num_steps
+        results[policy or 'float32'] = {'ms_per_step': ms_per_step,
+                                        'samples_per_sec': 1000. * base.TRAIN.BATCH_SIZE / ms_per_step,
+                                        'rss_delta_mb': rss_mb() - rss_before,
+                                        'peak_rss_mb': peak_rss_mb()}
+        logging.info('%s: %.1f ms/step', policy or 'float32', results[policy or 'float32']['ms_per_step'])
+    tf.keras.mixed_precision.experimental.set_policy('float32')
+    return results
+
+
+def save_results(results):
+    output_dir = os.path.dirname(FLAGS.output)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(FLAGS.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info('Results written to %s', FLAGS.output)
+
+
+def main(_argv):
+    if FLAGS.train_steps > 0:
+        policy = FLAGS.precision or cfg.TRAIN.MIXED_PRECISION
+        save_results({'train_steps': FLAGS.train_steps, 'batch_size': cfg.TRAIN.BATCH_SIZE,
+                      'model': cfg.MODEL_NAME + '_' + cfg.BACKBONE_NAME,
+                      'precision': train_step_benchmark(cfg, ['', policy], FLAGS.train_steps)})
+        return
+
+    results = {'steps': FLAGS.steps, 'batch_size': cfg.TRAIN.BATCH_SIZE, 'val_batch_size': cfg.DATASET.VAL_BATCH_SIZE,
+               'source': cfg.DATASET.SOURCE, 'batched_augmentation': cfg.AUGMENTATION.BATCHED,
+               'uint8': cfg.DATASET.UINT8, 'train': {}}
+
+    # 训练集, 每种增广开关组合
+    for name, c in augmentation_variants(cfg).items():
+        results['train'][name] = measure(get_dataset(c.DATASET.TRAIN_DATA, c, is_training=True), FLAGS.steps)
+        logging.info('train %s: %.1f samples/sec', name, results['train'][name]['samples_per_sec'])
+
+    # 模型单步训练的吞吐量; pipeline_headroom 大于1时数据管道快于模型, 训练不会等待数据
+    if FLAGS.compare_model:
+        model = train_step_benchmark(cfg, [cfg.TRAIN.MIXED_PRECISION], FLAGS.steps)
+        results['model'] = model[cfg.TRAIN.MIXED_PRECISION or 'float32']
+        results['pipeline_headroom'] = results['train']['default']['samples_per_sec'] / results['model']['samples_per_sec']
+        logging.info('model: %.1f samples/sec, pipeline headroom: %.2fx',
+                     results['model']['samples_per_sec'], results['pipeline_headroom'])
+
+    if cfg.DATASET.SOURCE == 'record':
+        results['stages'] = stage_latency(cfg, FLAGS.steps)
+
+    # 验证集, 第一遍完整迭代时填充缓存, 第二遍只读缓存
+    val_dataset = get_dataset(cfg.DATASET.VAL_DATA, cfg)
+    results['val'] = {'cold': measure(val_dataset, 2 ** 31)}
+    results['val']['warm'] = measure(val_dataset, FLAGS.steps)
+    logging.info('val cold: %.1f samples/sec, warm: %.1f samples/sec',
+                 results['val']['cold']['samples_per_sec'], results['val']['warm']['samples_per_sec'])
+
+    if FLAGS.trace_dir:
+        tf.profiler.experimental.start(FLAGS.trace_dir)
+        measure(get_dataset(cfg.DATASET.TRAIN_DATA, cfg, is_training=True), FLAGS.steps)
+        tf.profiler.experimental.stop()
+
+    save_results(results)
+
+
+if __name__ == '__main__':
+    app.run(main)
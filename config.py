@@ -19,6 +19,9 @@ _C.TRAIN.OPTIMIZER = 'sgd'
 _C.TRAIN.RHO = 0.9
 _C.TRAIN.MOMENTUM = 0.9
 _C.TRAIN.SNAP_SHOT = 3
+_C.TRAIN.STRATEGY = ''    # '': 单设备; 'mirrored': 单机多设备; 'multi_worker': 多机/多进程, 由 TF_CONFIG 指定集群
+_C.TRAIN.ACCUM_STEPS = 1    # 梯度累加的 micro-batch 数, 每次参数更新的有效batch为 BATCH_SIZE * ACCUM_STEPS
+_C.TRAIN.MIXED_PRECISION = ''    # '': float32; 'mixed_float16': GPU, 使用损失缩放; 'mixed_bfloat16': CPU/TPU
 
 _C.DATASET = CN()
 _C.DATASET.TRAIN_DATA = './dataset/record/train.record*'
@@ -29,14 +32,34 @@ _C.DATASET.CHANNELS = 3
 _C.DATASET.N_CLASSES = 2
 _C.DATASET.LABELS = ['background', 'yang']
 _C.DATASET.NUM_TRAIN = 4475
+_C.DATASET.NUM_VAL = 0    # 验证样本数, 0 时从 VAL_DATA 的 manifest 读取; 多机训练需要它确定固定的验证步数
+_C.DATASET.SEED = 1234    # 分片列表的打乱种子, 多机训练时各 worker 必须相同, 否则按文件切分后的分片会重叠或遗漏
+_C.DATASET.UINT8 = False    # 样本以uint8经过 shuffle/batch/prefetch, 在训练步内转换; 只改变传输类型, 模型输入的分布不变
+_C.DATASET.NORMALIZE = False    # 模型输入按 MEAN/STD 归一化, 否则为 [0, 1]; 与 UINT8 无关, 需与 submit_version/run.py 的 NORMALIZE 一致
+_C.DATASET.MEAN = [0.65459856, 0.48386562, 0.69428385]    # datacut2.py 统计的均值和标准差
+_C.DATASET.STD = [0.15167958, 0.23584107, 0.13146145]
+_C.DATASET.CYCLE_LENGTH = 4    # 同时读取的TFRecord分片数
+_C.DATASET.DETERMINISTIC = False    # 并行读取和map时是否保持样本顺序
+_C.DATASET.VAL_BATCH_SIZE = 8
+_C.DATASET.VAL_CACHE_MB = 2048    # 验证集解码后 uint8 样本在内存中缓存的上限
+_C.DATASET.VAL_CACHE_DIR = './dataset/cache'    # 超出内存上限的验证样本缓存到该目录, 为空时每次重新读取; 缓存按进程区分, 不跨运行复用
+_C.DATASET.POS_RATIO = 0.    # 大于0时按前景索引以该比例抽取含肾小球的样本, 需用 img2record.py --fg_th=0 (或更大的阈值) 生成数据
+_C.DATASET.SOURCE = 'record'    # 训练数据来源, record: TFRecord; slide: 直接从切片随机采样
+_C.DATASET.SLIDE_DIR = './dataset/hubmap-kidney-segmentation/train'
+_C.DATASET.SLIDE_CSV = './dataset/hubmap-kidney-segmentation/train.csv'
+_C.DATASET.SLIDE_CACHE_DIR = './dataset/slide_cache'    # 缩小后的切片和掩码缓存
+_C.DATASET.SLIDE_REDUCE = 2    # 切片解码时的缩小倍数
+_C.DATASET.TILE_SIZE = 512    # 缩小后切片上的裁剪尺寸, 输出缩放到 RAW_SIZE
+_C.DATASET.SLIDE_WORKERS = 4    # 并行采样的生成器数量
 
 _C.SCHEDULER = CN()
 _C.SCHEDULER.LR_TYPE = 'exponential'    # piecewise, cosine_decay_restart
 _C.SCHEDULER.LR_INIT = 1e-1
 _C.SCHEDULER.LR_DECAY_RATE = 0.96
 _C.SCHEDULER.LR_LOWER_BOUND = 1e-5
-_C.SCHEDULER.LR_DECAY_STEPS = math.ceil(_C.DATASET.NUM_TRAIN / _C.TRAIN.BATCH_SIZE) * 3
-_C.SCHEDULER.WARMUP_STEPS = math.ceil(_C.DATASET.NUM_TRAIN / _C.TRAIN.BATCH_SIZE) * 10
+# 按优化器更新次数计数, 梯度累加时每个epoch的更新次数为 NUM_TRAIN / (BATCH_SIZE * ACCUM_STEPS)
+_C.SCHEDULER.LR_DECAY_STEPS = math.ceil(_C.DATASET.NUM_TRAIN / (_C.TRAIN.BATCH_SIZE * _C.TRAIN.ACCUM_STEPS)) * 3
+_C.SCHEDULER.WARMUP_STEPS = math.ceil(_C.DATASET.NUM_TRAIN / (_C.TRAIN.BATCH_SIZE * _C.TRAIN.ACCUM_STEPS)) * 10
 _C.SCHEDULER.CDR_T_MUL = 1.5
 _C.SCHEDULER.CDR_M_MUL = 0.5
 _C.SCHEDULER.NUM_PERIODS = 0.5
@@ -58,4 +81,25 @@ _C.LOSS.LABEL_SMOOTHING = 0.05
 _C.LOSS.WEIGHTS = [1, 1, 1, 1, 1, 1, 1, 1]
 
 _C.AUGMENTATION = CN()
+_C.AUGMENTATION.BATCHED = False    # 在batch之后对整个batch做颜色、翻转和缩放裁剪增广
+_C.AUGMENTATION.COLOR = True    # 对比度、亮度、饱和度
+_C.AUGMENTATION.FLIP = True
+_C.AUGMENTATION.SCALE_CROP = True    # 随机按步长缩放裁剪
+_C.AUGMENTATION.GRIDMASK = False
+_C.AUGMENTATION.CUTMIX = False
+
+_C.EVAL = CN()
+_C.EVAL.TIFF_DIR = './dataset/hubmap-kidney-segmentation/test'
+_C.EVAL.RESULT_DIR = './result/'
+_C.EVAL.TARGET_SIZE = (512, 512)
+_C.EVAL.STRIDE = 512      # stride 应该大于等于 1/2 target_size, 小于等于target_size
+_C.EVAL.RESIZE = 0.5
+_C.EVAL.BATCH_SIZE = 8    # 滑窗推理时每次送入模型的裁剪块数量
+_C.EVAL.TISSUE_REDUCE = 16    # 组织区域预筛选的缩小倍数, 0 表示不筛选
+_C.EVAL.S_TH = 40    # saturation blancking threshold
+_C.EVAL.P_TH = 200 * _C.EVAL.TARGET_SIZE[0] // 256    # threshold for the minimum number of pixels
+_C.EVAL.BLEND = False    # 重叠滑窗高斯加权融合概率, 建议配合 stride < target_size 使用
+_C.EVAL.SIGMA_SCALE = 0.125
+_C.EVAL.THRESHOLD = 0.5
+_C.EVAL.MEMMAP_DIR = ''    # 不为空时预测掩码和概率累加器使用该目录下的 np.memmap, 用于超大切片
 
@@ -2,23 +2,14 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from PIL import Image
-import tifffile as tiff
 import cv2
 import os
 from tqdm.notebook import tqdm
 import zipfile
-
-# RLE编码转图像
-def enc2mask(encs, shape):
-    img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
-    for m, enc in enumerate(encs):
-        if isinstance(enc, np.float) and np.isnan(enc): continue
-        s = enc.split()
-        for i in range(len(s) // 2):
-            start = int(s[2 * i]) - 1
-            length = int(s[2 * i + 1])
-            img[start:start + length] = 1 + m
-    return img.reshape(shape).T
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.slide import SlideReader
+from utils.rle import enc2mask
 
 
 # 图像转rle编码
@@ -59,27 +50,22 @@ if __name__ == '__main__':
             zipfile.ZipFile(OUT_MASKS, 'w') as mask_out:
         for index, encs in tqdm(df_masks.iterrows(), total=len(df_masks)):
             # read image and generate the mask
-            img = tiff.imread(os.path.join(DATA, index + '.tiff'))
-            if len(img.shape) == 5:
-                img = np.transpose(img.squeeze(), (1, 2, 0))
-            mask = enc2mask(encs, (img.shape[1], img.shape[0]))
+            # 按窗口惰性读取切片, 填充和缩小在分块读取时完成
+            slide = SlideReader(os.path.join(DATA, index + '.tiff'), cache_rows=0)
 
             # 填充外边界至步长整数倍
-            shape = img.shape
+            shape = slide.shape
             pad0 = (reduce * sz - shape[0] % (reduce * sz)) % (reduce * sz)
             pad1 = (reduce * sz - shape[1] % (reduce * sz)) % (reduce * sz)
-            img = np.pad(img, [[pad0 // 2, pad0 - pad0 // 2], [pad1 // 2, pad1 - pad1 // 2], [0, 0]],
-                         constant_values=0)
-            mask = np.pad(mask, [[pad0 // 2, pad0 - pad0 // 2], [pad1 // 2, pad1 - pad1 // 2]],
-                          constant_values=0)
+            img = slide.read(-(pad1 // 2), -(pad0 // 2), shape[1] + pad1, shape[0] + pad0, reduce=reduce)
+            slide.close()
+            # 直接解码为填充并缩小后的掩码
+            mask = enc2mask(encs, (shape[1], shape[0]), reduce=reduce,
+                            pad=[[pad0 // 2, pad0 - pad0 // 2], [pad1 // 2, pad1 - pad1 // 2]])
             # split image and mask into tiles using the reshape+transpose trick
-            img = cv2.resize(img, (img.shape[1] // reduce, img.shape[0] // reduce),
-                             interpolation=cv2.INTER_AREA)
             img = img.reshape(img.shape[0] // sz, sz, img.shape[1] // sz, sz, 3)
             img = img.transpose(0, 2, 1, 3, 4).reshape(-1, sz, sz, 3)
 
-            mask = cv2.resize(mask, (mask.shape[1] // reduce, mask.shape[0] // reduce),
-                              interpolation=cv2.INTER_NEAREST)
             mask = mask.reshape(mask.shape[0] // sz, sz, mask.shape[1] // sz, sz)
             mask = mask.transpose(0, 2, 1, 3).reshape(-1, sz, sz)
 
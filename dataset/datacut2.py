@@ -7,11 +7,14 @@ import cv2
 from PIL import Image
 from tqdm import tqdm
 import os
-import tifffile as tiff
 from argparse import ArgumentParser
 from multiprocessing import Pool
 from absl import logging, flags, app
 from absl.flags import FLAGS
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.slide import SlideReader, crop_pad
+from utils.rle import enc2band
 
 Image.MAX_IMAGE_PIXELS = 1000000000000
 
@@ -20,19 +23,7 @@ flags.DEFINE_string('mask_dir', '../dataset/masks', '裁剪后数据保存路径
 flags.DEFINE_string('vis_dir', '../dataset/visual', '裁剪后数据保存路径')
 flags.DEFINE_string('csv_dir', '../dataset/hubmap-kidney-segmentation/train.csv', 'train_csv')
 flags.DEFINE_string('tiff_dir', './hubmap-kidney-segmentation/train/', 'tiff')
-
-
-# RLE编码转图像
-def enc2mask(encs, shape):
-    img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
-    for m, enc in enumerate(encs):
-        if isinstance(enc, np.float) and np.isnan(enc): continue
-        s = enc.split()
-        for i in range(len(s) // 2):
-            start = int(s[2 * i]) - 1
-            length = int(s[2 * i + 1])
-            img[start:start + length] = 1 + m
-    return img.reshape(shape).T
+flags.DEFINE_integer('num_workers', 4, '并行裁剪的进程数, 每个进程只持有当前一行裁剪块对应的掩码条带')
 
 
 # 图像转rle编码
@@ -51,10 +42,11 @@ def mask2rle(mask, n=1):
     return encs
 
 
-def crop(_cnt, _crop_image, _mask_label, _img):
-    image_name = os.path.join(FLAGS.image_dir, _img + "_" + str(_cnt) + ".png")
-    mask_name = os.path.join(FLAGS.mask_dir, _img + "_" + str(_cnt) + ".png")
-    vis_name = os.path.join(FLAGS.vis_dir, _img + "_" + str(_cnt) + ".png")
+def crop(_cnt, _crop_image, _mask_label, _img, _dirs):
+    image_dir, mask_dir, vis_dir = _dirs
+    image_name = os.path.join(image_dir, _img + "_" + str(_cnt) + ".png")
+    mask_name = os.path.join(mask_dir, _img + "_" + str(_cnt) + ".png")
+    vis_name = os.path.join(vis_dir, _img + "_" + str(_cnt) + ".png")
     _crop_image = cv2.cvtColor(_crop_image, cv2.COLOR_RGB2BGR)
     cv2.imwrite(image_name, _crop_image)
     cv2.imwrite(mask_name, _mask_label)
@@ -72,6 +64,53 @@ def creat_dir():
         os.makedirs(FLAGS.vis_dir)
 
 
+def cut_slide(args):
+    """
+    裁剪单张切片, 在子进程中运行; 所需参数全部显式传入, 不依赖子进程中的 FLAGS
+    :return: (保留的裁剪块数, 各块均值之和, 各块平方均值之和)
+    """
+    index, encs, tiff_dir, dirs, stride, target_size, s_th, p_th = args
+    target_w, target_h = target_size
+    # 按窗口惰性读取切片, 不把整张TIFF读入内存; 逐行裁剪, 块缓存容纳一行裁剪块
+    slide = SlideReader(os.path.join(tiff_dir, index + '.tiff'), cache_rows=target_h)
+
+    cnt = 0
+    x_sum, x2_sum = np.zeros(3), np.zeros(3)
+    # 填充外边界至裁剪尺寸整数倍
+    h, w = slide.shape[0], slide.shape[1]
+    new_w = (w // target_w) * target_w if (w % target_w == 0) else (w // target_w + 1) * target_w
+    new_h = (h // target_h) * target_h if (h % target_h == 0) else (h // target_h + 1) * target_h
+
+    # 填充1/2 stride长度的外边框, 超出切片的部分由 crop_pad 填0
+    pad = stride // 2
+    h, w = new_h + pad * 2, new_w + pad * 2
+
+    for i in range(h // stride - 1):
+        topleft_y = i * stride
+        # 每行裁剪块只解码对应的掩码条带, 不生成整张切片的原分辨率掩码
+        mask = enc2band(encs, (slide.shape[1], slide.shape[0]), topleft_y - pad, topleft_y - pad + target_h)
+        for j in range(w // stride - 1):
+            topleft_x = j * stride
+            crop_image = slide.read(topleft_x - pad, topleft_y - pad, target_w, target_h)
+            crop_label = crop_pad(mask, topleft_x - pad, 0, target_w, target_h)
+
+            if crop_image.shape[:2] != (target_h, target_h):
+                print(topleft_x, topleft_y, crop_image.shape)
+            #
+            hsv = cv2.cvtColor(crop_image, cv2.COLOR_BGR2HSV)
+            _, s, _ = cv2.split(hsv)
+            if (s > s_th).sum() <= p_th or crop_image.sum() <= p_th:
+                pass
+            else:
+                crop(cnt, crop_image, crop_label, index, dirs)
+                cnt += 1
+                x_sum += (crop_image / 255.0).reshape(-1, 3).mean(0)
+                x2_sum += ((crop_image / 255.0) ** 2).reshape(-1, 3).mean(0)
+    slide.close()
+
+    return cnt, x_sum, x2_sum
+
+
 def data_cut(_argv):
     stride = 900
     target_size = (1024, 1024)
@@ -79,54 +118,23 @@ def data_cut(_argv):
     p_th = 200 * target_size[0] // 256  # threshold for the minimum number of pixels
     creat_dir()
     df_masks = pd.read_csv(FLAGS.csv_dir).set_index('id')
+    dirs = (FLAGS.image_dir, FLAGS.mask_dir, FLAGS.vis_dir)
+
+    jobs = [(index, list(encs), FLAGS.tiff_dir, dirs, stride, target_size, s_th, p_th)
+            for index, encs in df_masks.iterrows()]
 
-    x_tot, x2_tot = [], []
-    for index, encs in tqdm(df_masks.iterrows(), total=len(df_masks)):
-        image = tiff.imread(os.path.join(FLAGS.tiff_dir, index + '.tiff'))
-        if len(image.shape) == 5:
-            image = np.transpose(image.squeeze(), (1, 2, 0))
-        mask = enc2mask(encs, (image.shape[1], image.shape[0]))
-
-        cnt = 0
-        # 填充外边界至裁剪尺寸整数倍
-        target_w, target_h = target_size
-        h, w = image.shape[0], image.shape[1]
-        new_w = (w // target_w) * target_w if (w % target_w == 0) else (w // target_w + 1) * target_w
-        new_h = (h // target_h) * target_h if (h % target_h == 0) else (h // target_h + 1) * target_h
-        image = cv2.copyMakeBorder(image, 0, new_h - h, 0, new_w - w, cv2.BORDER_CONSTANT, value=(0, 0, 0))
-        mask = cv2.copyMakeBorder(mask, 0, new_h - h, 0, new_w - w, cv2.BORDER_CONSTANT, value=0)
-
-        # 填充1/2 stride长度的外边框
-        image = cv2.copyMakeBorder(image, stride // 2, stride // 2, stride // 2, stride // 2, cv2.BORDER_CONSTANT,
-                                   value=(0, 0, 0))
-        mask = cv2.copyMakeBorder(mask, stride // 2, stride // 2, stride // 2, stride // 2, cv2.BORDER_CONSTANT,
-                                  value=0)
-
-        h, w = image.shape[0], image.shape[1]
-
-        for i in tqdm(range(h // stride - 1)):
-            for j in range(w // stride - 1):
-                topleft_x = j * stride
-                topleft_y = i * stride
-                crop_image = image[topleft_y:topleft_y + target_h, topleft_x:topleft_x + target_w]
-                crop_label = mask[topleft_y:topleft_y + target_h, topleft_x:topleft_x + target_w]
-
-                if crop_image.shape[:2] != (target_h, target_h):
-                    print(topleft_x, topleft_y, crop_image.shape)
-                #
-                hsv = cv2.cvtColor(crop_image, cv2.COLOR_BGR2HSV)
-                _, s, _ = cv2.split(hsv)
-                if (s > s_th).sum() <= p_th or crop_image.sum() <= p_th:
-                    pass
-                else:
-                    crop(cnt, crop_image, crop_label, index)
-                    cnt += 1
-                    x_tot.append((crop_image / 255.0).reshape(-1, 3).mean(0))
-                    x2_tot.append(((crop_image / 255.0) ** 2).reshape(-1, 3).mean(0))
+    # 按切片分配到进程池, 每个进程返回各自的统计量再合并
+    n_tot, x_tot, x2_tot = 0, np.zeros(3), np.zeros(3)
+    with Pool(FLAGS.num_workers) as pool:
+        for cnt, x_sum, x2_sum in tqdm(pool.imap_unordered(cut_slide, jobs), total=len(jobs)):
+            n_tot += cnt
+            x_tot += x_sum
+            x2_tot += x2_sum
 
     # image stats
-    img_avr = np.array(x_tot).mean(0)
-    img_std = np.sqrt(np.array(x2_tot).mean(0) - img_avr ** 2)
+    img_avr = x_tot / n_tot
+    img_std = np.sqrt(x2_tot / n_tot - img_avr ** 2)
+    print('tiles:', n_tot)
     print('mean:', img_avr, ', std:', img_std)
 
 
@@ -1,11 +1,18 @@
 import os
+import io
+import sys
+import json
+import time
+import multiprocessing
 import numpy as np
 from PIL import Image
 import tensorflow as tf
 from absl import app, flags, logging
 from absl.flags import FLAGS
 from tqdm import trange
-import contextlib2
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import cfg
+from utils.data_aug import RAW_SCHEMA, manifest_name, _parse_tfrecord
 
 flags.DEFINE_string('dataset', '../dataset/train', '训练集路径')
 flags.DEFINE_string('train_record_path', '../dataset/record/train.record', '训练集存储路径')
@@ -13,6 +20,12 @@ flags.DEFINE_string('val_record_path', '../dataset/record/val.record', '验证
 flags.DEFINE_string('test_record_path', '../dataset/record/test.record', '验证集存储路径')
 flags.DEFINE_string('train_txt', '../dataset/train.txt', '训练集txt路径')
 flags.DEFINE_string('val_txt', '../dataset/val.txt', '验证集txt路径')
+flags.DEFINE_integer('num_workers', os.cpu_count(), '并行写入TFRecord的进程数')
+flags.DEFINE_enum('record_format', 'raw', ['raw', 'png', 'jpeg'], '图像存储格式: 原始字节或PNG/JPEG编码, 后两者的掩码均为PNG编码')
+flags.DEFINE_enum('compression', '', ['', 'GZIP', 'ZLIB'], 'TFRecord压缩方式, 对原始字节和编码格式均生效, 写入 manifest')
+flags.DEFINE_float('fg_th', -1., '大于等于0时建立前景索引, 前景比例大于该值的训练样本视为正样本并单独写入分片(配合 cfg.DATASET.POS_RATIO);'
+                   ' 默认 -1 不建立索引, 样本轮流写入各分片, 每个分片都是训练集的均匀样本')
+flags.DEFINE_string('benchmark_dir', '', '不为空时只在该目录下比较各存储格式的磁盘占用和解析吞吐量')
 
 
 def get_files(file_dir, ratio=0.9):
@@ -92,76 +105,190 @@ def image2tfrecord(image_list, filename):
     writer.close()
 
 
-def open_sharded_output_tfrecords(exit_stack, base_path, num_shards):
-    """Opens all TFRecord shards for writing and adds them to an exit stack.
-  Args:
-    exit_stack: A context2.ExitStack used to automatically closed the TFRecords
-      opened in this function.
-    base_path: The base path for all shards
-    num_shards: The number of shards
-  Returns:
-    The list of opened TFRecords. Position k in the list corresponds to shard k.
-  """
-    tf_record_output_filenames = [
-        '{}-{:05d}-of-{:05d}'.format(base_path, idx, num_shards)
-        for idx in range(num_shards)
-    ]
+# 生成字符串型的属性
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
-    tfrecords = [
-        exit_stack.enter_context(tf.io.TFRecordWriter(file_name))
-        for file_name in tf_record_output_filenames
-    ]
 
-    return tfrecords
+# 生成整数型的属性
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
 
-def create2records(image_list, label_list, output_path, num_shards):
-    # 生成字符串型的属性
-    def _bytes_feature(value):
-        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+def serialize_example(image_path, label_path, schema=RAW_SCHEMA):
+    image = Image.open(image_path)
+    image = image.resize((512, 512))
+    label = Image.open(label_path)
+    label = label.resize((512, 512), 0)
 
-    # 生成整数型的属性
-    def _int64_feature(value):
-        return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
-    with contextlib2.ExitStack() as tf_record_close_stack:
-        output_tfrecords = open_sharded_output_tfrecords(
-            tf_record_close_stack, output_path, num_shards)
-        for idx, image in enumerate(image_list):
-            if idx % 100 == 0:
-                logging.info('On image %d of %d', idx, len(image_list))
-            image = Image.open(image)
-            image = image.resize((512, 512))
-            label = Image.open(label_list[idx])
-            label = label.resize((512, 512), 0)
-            # 转化为原始字节
-            image_bytes = image.tobytes()
-            label_bytes = label.tobytes()
-
-            # 创建字典
-            features = {}
-            # 用bytes来存储image
-            features['image_raw'] = _bytes_feature(image_bytes)
-            # 用bytes来存储label
-            features['label_image'] = _bytes_feature(label_bytes)
-            # 将所有的feature合成features
-            tf_features = tf.train.Features(feature=features)
-            # 将样本转成Example Protocol Buffer，并将所有的信息写入这个数据结构
-            tf_example = tf.train.Example(features=tf_features)
-            # 序列化样本
-            tf_serialized = tf_example.SerializeToString()
-
-            shard_idx = idx % num_shards
-            output_tfrecords[shard_idx].write(tf_serialized)
-        logging.info('Finished writing %d images', idx + 1)
+    # 创建字典
+    features = {}
+    if schema['format'] == 'encoded':
+        # 图像按 image_codec 编码, 掩码用无损PNG编码
+        image_buf, label_buf = io.BytesIO(), io.BytesIO()
+        if schema['image_codec'] == 'jpeg':
+            image.save(image_buf, format='JPEG', quality=95)
+        else:
+            image.save(image_buf, format='PNG')
+        label.save(label_buf, format='PNG')
+        features['image_encoded'] = _bytes_feature(image_buf.getvalue())
+        features['label_encoded'] = _bytes_feature(label_buf.getvalue())
+    else:
+        # 转化为原始字节
+        image_bytes = image.tobytes()
+        label_bytes = label.tobytes()
+        # 用bytes来存储image
+        features['image_raw'] = _bytes_feature(image_bytes)
+        # 用bytes来存储label
+        features['label_image'] = _bytes_feature(label_bytes)
+    # 将所有的feature合成features
+    tf_features = tf.train.Features(feature=features)
+    # 将样本转成Example Protocol Buffer，并将所有的信息写入这个数据结构
+    tf_example = tf.train.Example(features=tf_features)
+    # 序列化样本
+    return tf_example.SerializeToString()
+
+
+def shard_name(base_path, idx, num_shards):
+    return '{}-{:05d}-of-{:05d}'.format(base_path, idx, num_shards)
+
+
+# 掩码中前景像素的比例
+def foreground_fraction(label_path):
+    label = Image.open(label_path).resize((512, 512), 0)
+    return float(np.mean(np.asarray(label) > 0))
+
+
+def assign_shards(num_samples, num_shards, fractions=None, fg_th=0.):
+    """
+    把样本分配到分片; 给定 fractions 时, 前景比例大于 fg_th 的正样本写入前 num_pos 个分片, 其余写入后面的分片,
+    各组分片数与样本数成比例, 训练时可按分片分别读取正负样本
+    :return: ({分片序号: 样本下标列表}, 正样本分片序号列表)
+    """
+    if fractions is not None and num_shards >= 2:
+        pos = [i for i, f in enumerate(fractions) if f > fg_th]
+        neg = [i for i, f in enumerate(fractions) if f <= fg_th]
+        if pos and neg:
+            num_pos = min(max(int(round(num_shards * len(pos) / num_samples)), 1), num_shards - 1)
+            shards = {k: pos[k::num_pos] for k in range(num_pos)}
+            shards.update({num_pos + k: neg[k::num_shards - num_pos] for k in range(num_shards - num_pos)})
+            return shards, list(range(num_pos))
+    # 样本按 idx % num_shards 轮询分配
+    return {k: list(range(k, num_samples, num_shards)) for k in range(num_shards)}, []
+
+
+def write_shards(args):
+    """
+    子进程中写入属于自己的若干个分片
+    :return: {分片文件名: 样本数}
+    """
+    image_list, label_list, output_path, num_shards, shards, schema = args
+    options = tf.io.TFRecordOptions(compression_type=schema['compression'])
+    counts = {}
+    for shard_idx, indices in shards.items():
+        file_name = shard_name(output_path, shard_idx, num_shards)
+        with tf.io.TFRecordWriter(file_name, options) as writer:
+            for idx in indices:
+                writer.write(serialize_example(image_list[idx], label_list[idx], schema))
+        counts[os.path.basename(file_name)] = len(indices)
+    return counts
+
+
+def create2records(image_list, label_list, output_path, num_shards, num_workers=1, schema=RAW_SCHEMA,
+                   fg_th=None):
+    """
+    并行写入分片TFRecord, 每个进程负责 shard_idx % num_workers 相同的分片, 独立完成读取、缩放和序列化
+    写完后在 manifest_name(output_path) 中记录数据格式和每个分片的样本数, get_dataset 据此自动选择解析方式
+    给定 fg_th 时先计算每个样本的前景比例, 按 assign_shards 将正负样本写入不同分片,
+    manifest 中记录正样本分片和每个分片内按写入顺序排列的前景比例索引
+    """
+    num_workers = max(min(num_workers, num_shards), 1)
+    # spawn 启动的子进程不会继承父进程中已初始化的 TensorFlow 运行时
+    pool = multiprocessing.get_context('spawn').Pool(num_workers) if num_workers > 1 else None
+    try:
+        fractions = None
+        if fg_th is not None:
+            fractions = pool.map(foreground_fraction, label_list, chunksize=64) if pool is not None \
+                else [foreground_fraction(p) for p in label_list]
+        shards, pos_shards = assign_shards(len(image_list), num_shards, fractions, fg_th)
+        jobs = [(image_list, label_list, output_path, num_shards,
+                 {k: shards[k] for k in range(w, num_shards, num_workers)}, schema) for w in range(num_workers)]
+        counts = {}
+        if pool is None:
+            counts.update(write_shards(jobs[0]))
+        else:
+            for shard_counts in pool.imap_unordered(write_shards, jobs):
+                counts.update(shard_counts)
+                logging.info('Finished shards %s', sorted(shard_counts))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    manifest = {'schema': schema, 'num_shards': num_shards, 'num_records': sum(counts.values()),
+                'shards': {k: counts[k] for k in sorted(counts)}}
+    if fractions is not None:
+        names = [os.path.basename(shard_name(output_path, k, num_shards)) for k in range(num_shards)]
+        manifest['fg_th'] = fg_th
+        manifest['positive_shards'] = [names[k] for k in pos_shards]
+        manifest['fg_index'] = {names[k]: [round(fractions[i], 4) for i in shards[k]] for k in range(num_shards)}
+    with open(manifest_name(output_path), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    logging.info('Finished writing %d images, %d positive shards', manifest['num_records'], len(pos_shards))
+    return manifest
+
+
+def benchmark_formats(image_list, label_list, output_dir, num_samples=200):
+    """
+    用同一批样本分别写入几种格式, 比较磁盘占用和 get_dataset 解析吞吐量
+    """
+    image_list, label_list = image_list[:num_samples], label_list[:num_samples]
+    schemas = {
+        'raw': RAW_SCHEMA,
+        'raw_gzip': dict(RAW_SCHEMA, compression='GZIP'),
+        'png': {'format': 'encoded', 'image_codec': 'png', 'compression': ''},
+        'png_gzip': {'format': 'encoded', 'image_codec': 'png', 'compression': 'GZIP'},
+        'jpeg_zlib': {'format': 'encoded', 'image_codec': 'jpeg', 'compression': 'ZLIB'},
+    }
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    results = {}
+    for name, schema in schemas.items():
+        base_path = os.path.join(output_dir, name + '.record')
+        create2records(image_list, label_list, base_path, 1, 1, schema)
+        file_name = shard_name(base_path, 0, 1)
+        dataset = tf.data.TFRecordDataset(file_name, compression_type=schema['compression'])
+        dataset = dataset.map(lambda x: _parse_tfrecord(x, cfg, schema))
+        # 第一遍预热, 第二遍计时
+        for _ in dataset:
+            pass
+        start = time.time()
+        for _ in dataset:
+            pass
+        elapsed = time.time() - start
+        results[name] = {'bytes': os.path.getsize(file_name),
+                         'samples_per_sec': len(image_list) / elapsed}
+        logging.info('%s: %.1f MB, %.1f samples/sec', name, results[name]['bytes'] / 2 ** 20,
+                     results[name]['samples_per_sec'])
+    with open(os.path.join(output_dir, 'benchmark.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+    return results
 
 
 def main(_grgv):
     train_images, train_labels, val_images, val_labels = get_files(FLAGS.dataset)
+    if FLAGS.benchmark_dir:
+        benchmark_formats(train_images, train_labels, FLAGS.benchmark_dir)
+        return
+    schema = dict(RAW_SCHEMA, compression=FLAGS.compression)
+    if FLAGS.record_format != 'raw':
+        schema = {'format': 'encoded', 'image_codec': FLAGS.record_format, 'compression': FLAGS.compression}
     # image2tfrecord(test_list, FLAGS.test_record_path)
-    create2records(train_images, train_labels, FLAGS.train_record_path, 20)
-    create2records(val_images, val_labels, FLAGS.val_record_path, 1)
+    fg_th = FLAGS.fg_th if FLAGS.fg_th >= 0 else None
+    create2records(train_images, train_labels, FLAGS.train_record_path, 20, FLAGS.num_workers, schema, fg_th)
+    create2records(val_images, val_labels, FLAGS.val_record_path, 1, FLAGS.num_workers, schema)
 
 
 if __name__ == '__main__':
 
-    app.run(main)
\ No newline at end of file
+    app.run(main)
@@ -2,7 +2,6 @@ import numpy as np
 import cv2
 import os
 import tensorflow as tf
-import tifffile as tiff
 import pandas as pd
 from PIL import Image
 from models.model_summary import create_model
@@ -10,36 +9,24 @@ from config import cfg
 from tqdm import tqdm
 from utils.visualization import vis_segmentation
 from utils.util import set_device
-
-
-# 图像转rle编码
-def mask2rle(img):
-    """
-    Efficient implementation of mask2rle, from @paulorzp
-    https://www.kaggle.com/xhlulu/efficient-mask2rle
-    https://www.kaggle.com/paulorzp/rle-functions-run-lenght-encode-decode
-    --
-    img: numpy array, 1 - mask, 0 - background
-    Returns run length as string formated
-    """
-    pixels = img.T.flatten()
-    pixels = np.pad(pixels, ((1, 1), ))
-    runs = np.where(pixels[1:] != pixels[:-1])[0] + 1
-    runs[1::2] -= runs[::2]
-    return ' '.join(str(x) for x in runs)
+from utils.data_aug import normalize_image
+from utils.rle import mask2rle
+from utils.slide import SlideReader, ScaledPaddedView
+from utils.inference import TileEngine, ProbAccumulator, tile_coords, tissue_tiles, gaussian_window, \
+    alloc_array, remove_array, resize_nearest, peak_rss_mb
 
 
 def eval_img():
-    tiff_dir = './dataset/hubmap-kidney-segmentation/test'
+    tiff_dir = cfg.EVAL.TIFF_DIR
 
-    test_mask_path = './result/'
+    test_mask_path = cfg.EVAL.RESULT_DIR
     if not os.path.isdir(test_mask_path):
         os.makedirs(test_mask_path)
-    target_size = (512, 512)
-    stride = 512      # stride 应该大于等于 1/2 target_size, 小于等于target_size
+    target_size = cfg.EVAL.TARGET_SIZE
+    stride = cfg.EVAL.STRIDE      # stride 应该大于等于 1/2 target_size, 小于等于target_size
     hstride = stride // 2
     dis_wh = (target_size[0] - stride) // 2
-    resize = 0.5
+    resize = cfg.EVAL.RESIZE
 
     test = pd.DataFrame(columns=['id', 'predicted'])
 
@@ -54,78 +41,106 @@ def eval_img():
 
     @tf.function
     def tta_interfence(y):
-        y = y / 255.
+        y = normalize_image(y, cfg)
         out_ = model(y, training=False)
         # out_, _, _, _, _ = model(y, training=False)
         return out_
 
+    # 整个batch在图内完成softmax和argmax, 只把uint8标签传回host
+    @tf.function
+    def batch_interfence(y):
+        out_ = tta_interfence(y)
+        return tf.cast(tf.argmax(tf.math.softmax(out_), axis=-1), tf.uint8)
+
+    # 融合模式下传回float16前景概率
+    @tf.function
+    def batch_prob_interfence(y):
+        out_ = tta_interfence(y)
+        return tf.cast(tf.math.softmax(out_)[..., 1], tf.float16)
+
+    blend = cfg.EVAL.BLEND
+    predict_fn = batch_prob_interfence if blend else batch_interfence
+    engine = TileEngine(lambda y: predict_fn(tf.convert_to_tensor(y)), target_size,
+                        batch_size=cfg.EVAL.BATCH_SIZE, dtype=np.uint8)
+    window = gaussian_window(target_size, sigma_scale=cfg.EVAL.SIGMA_SCALE)
+    memmap_dir = cfg.EVAL.MEMMAP_DIR
+
     for img in os.listdir(tiff_dir):
         if not img.endswith('tiff'):
             continue
         image_path = os.path.join(tiff_dir, img)
-        image = tiff.imread(image_path)
-        image = np.asarray(image)
-        if len(image.shape) == 5:
-            image = np.transpose(image.squeeze(), (1, 2, 0))
-        hh, ww = image.shape[0], image.shape[1]
-        image = cv2.resize(image, (int(image.shape[1] * resize), int(image.shape[0] * resize)))
+        # 按窗口惰性读取切片, 不把整张TIFF读入内存; 块缓存容纳一行裁剪块, tile_coords 按行优先顺序读取
+        slide = SlideReader(image_path, cache_rows=int(np.ceil(target_size[1] / resize)))
+        hh, ww = slide.shape[0], slide.shape[1]
 
         # 填充外边界至步长整数倍
-        h, w = image.shape[0], image.shape[1]
+        h, w = int(hh * resize), int(ww * resize)
         target_w, target_h = target_size
         new_w = (w // target_w) * target_w if (w % target_w == 0) else (w // target_w + 1) * target_w
         new_h = (h // target_h) * target_h if (h % target_h == 0) else (h // target_h + 1) * target_h
-        image = cv2.copyMakeBorder(image, 0, new_h - h, 0, new_w - w, cv2.BORDER_CONSTANT, 0)
 
         # 填充1/2 stride长度的外边框
-        new_w, new_h = image.shape[1] + stride, image.shape[0] + stride
-        image = cv2.copyMakeBorder(image, stride // 2, stride // 2, stride // 2, stride // 2, cv2.BORDER_CONSTANT, 0)
-        png = np.zeros((new_h, new_w), np.uint8)
-        image_old = np.zeros((new_h, new_w, 3), np.uint8)
+        new_w, new_h = new_w + stride, new_h + stride
+        image = ScaledPaddedView(slide, resize, (new_h, new_w), stride // 2)
+        png = alloc_array((new_h, new_w), np.uint8, memmap_dir, 'png')
 
         h_, w_ = image.shape[0], image.shape[1]
 
-        for i in tqdm(range(w_ // stride - 1)):
-            for j in range(h_ // stride - 1):
-                topleft_x = i * stride
-                topleft_y = j * stride
-                buttomright_y = topleft_y + target_h
-                buttomright_x = topleft_x + target_h
-                crop_image = image[topleft_y:buttomright_y, topleft_x:buttomright_x]
-                if crop_image.shape[:2] != (target_h, target_h):
-                    print(topleft_x, topleft_y, crop_image.shape)
-
-                image_old[topleft_y + dis_wh:buttomright_y - dis_wh, topleft_x + dis_wh:buttomright_x - dis_wh] = \
-                    crop_image[dis_wh:target_size[0] - dis_wh, dis_wh:target_size[1] - dis_wh]
-
-                crop_image = tf.cast(tf.expand_dims(crop_image, axis=0), dtype=tf.float32)
-                out = tta_interfence(crop_image)
-                out = np.squeeze(np.argmax(tf.math.softmax(out), axis=-1))
-                # cv2.imwrite(test_mask_path + img[:-4] + "_" + str(i) + str(j) + ".jpg", out * 255)
-
-                png[topleft_y + dis_wh:buttomright_y - dis_wh, topleft_x + dis_wh:buttomright_x - dis_wh] = \
-                    out[dis_wh:target_size[0] - dis_wh, dis_wh:target_size[1] - dis_wh]
-
-                x = out[dis_wh:target_size[0] - dis_wh, dis_wh:target_size[1] - dis_wh]
+        coords = tile_coords(h_, w_, stride, target_size)
+        # 空白玻片和黑色填充区域直接视为背景, 不送入模型
+        skipped = []
+        if cfg.EVAL.TISSUE_REDUCE > 0:
+            coords, skipped = tissue_tiles(None, coords, target_size, reduce=cfg.EVAL.TISSUE_REDUCE,
+                                           s_th=cfg.EVAL.S_TH, p_th=cfg.EVAL.P_TH,
+                                           small=image.thumbnail(cfg.EVAL.TISSUE_REDUCE))
+        print('{}: inferred {} tiles, skipped {} tiles'.format(img, len(coords), len(skipped)))
+
+        if blend:
+            accumulator = ProbAccumulator((new_h, new_w), window, memmap_dir=memmap_dir)
+
+        for (topleft_x, topleft_y), out in tqdm(engine.run(image, coords), total=len(coords)):
+            if blend:
+                accumulator.add(topleft_x, topleft_y, out)
+                continue
+            buttomright_y = topleft_y + target_h
+            buttomright_x = topleft_x + target_w
+            png[topleft_y + dis_wh:buttomright_y - dis_wh, topleft_x + dis_wh:buttomright_x - dis_wh] = \
+                out[dis_wh:target_size[0] - dis_wh, dis_wh:target_size[1] - dis_wh]
+
+        if blend:
+            png = accumulator.result(cfg.EVAL.THRESHOLD, out=png)
+            accumulator.close()
 
         png = png[hstride:new_h - hstride, hstride:new_w - hstride]
         png = png[:h, :w]
-        # png = png * 255
-        png = cv2.resize(png, (ww, hh), cv2.INTER_NEAREST)
-        cv2.imwrite(test_mask_path + img[:-5] + '_mask.png', png * 255)
-
-        image_old = image_old[hstride:new_h - hstride, hstride:new_w - hstride]
-        image_old = image_old[:h, :w]
-        image_old = cv2.resize(image_old, (ww, hh))
-        cv2.imwrite(test_mask_path + img[:-5] + '.jpg', image_old)
-
-        encs = mask2rle(png)
+        if memmap_dir:
+            # 超大切片的可视化结果在缩略图分辨率下生成, 不分配推理分辨率或原分辨率的数组
+            reduce = cfg.EVAL.TISSUE_REDUCE if cfg.EVAL.TISSUE_REDUCE > 0 else 16
+            thumb = image.thumbnail(reduce)[hstride // reduce:, hstride // reduce:][:h // reduce, :w // reduce]
+            cv2.imwrite(test_mask_path + img[:-5] + '_mask.png',
+                        resize_nearest(png, (thumb.shape[1], thumb.shape[0])) * 255)
+            cv2.imwrite(test_mask_path + img[:-5] + '.jpg', thumb)
+        else:
+            # png = png * 255
+            cv2.imwrite(test_mask_path + img[:-5] + '_mask.png', resize_nearest(png, (ww, hh)) * 255)
+
+            image_old = slide.read(0, 0, ww, hh, reduce=max(int(round(1 / resize)), 1))
+            image_old = cv2.resize(image_old, (ww, hh))
+            cv2.imwrite(test_mask_path + img[:-5] + '.jpg', image_old)
+        slide.close()
+
+        # 直接由推理分辨率的掩码按列分块编码, 不生成原分辨率掩码
+        encs = mask2rle(png, full_shape=(hh, ww))
         new = pd.DataFrame({'id': [img], 'predicted': [encs]}, index=[1])
         test = test.append(new, ignore_index=True)
+        # 删除本张切片的 memmap 文件
+        del png
+        remove_array(memmap_dir, 'png')
 
         # vis_segmentation(np.array(image_old).astype(np.int64), png, ['yin', 'yang'])
 
     test.to_csv('submission.csv', sep=',', index=False)
+    print('peak RSS: {:.1f} MB'.format(peak_rss_mb()))
 
 
 if __name__ == '__main__':
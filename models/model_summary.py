@@ -1,3 +1,5 @@
+from tensorflow.keras.layers import Activation
+from tensorflow.keras.models import Model
 from models.unet2s import Xnet_s
 from models.unet2plus import Xnet
 from models.deeplabv3plus import Deeplabv3
@@ -84,4 +86,24 @@ def create_model(cfg, name, backbone):
     else:
         raise TypeError('Unsupported model type')
 
+    if cfg.TRAIN.MIXED_PRECISION:
+        model = float32_outputs(model)
+
     return model
+
+
+def float32_outputs(model):
+    """
+    混合精度时把模型的最后一个激活层替换为 float32 计算, 其余输出直接转为 float32, 保证 softmax/sigmoid 的数值稳定
+    """
+    if not model.outputs:
+        return model
+    outputs = []
+    for output in model.outputs:
+        layer = output._keras_history.layer
+        if isinstance(layer, Activation):
+            output = Activation(layer.activation, dtype='float32', name=layer.name + '_float32')(layer.input)
+        else:
+            output = Activation('linear', dtype='float32')(output)
+        outputs.append(output)
+    return Model(model.inputs, outputs, name=model.name)
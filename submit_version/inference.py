@@ -0,0 +1,95 @@
+# 由 sync_helpers.py 从 utils/inference.py 生成, 不要手动修改
+import os
+import numpy as np
+import cv2
+
+
+# 滑动窗口左上角坐标
+def tile_coords(h, w, stride, target_size):
+    """
+    按行优先顺序生成滑动窗口左上角坐标, 同一行的裁剪块连续读取, 条带存储的TIFF每个条带只需解码一次(见 SlideReader)
+    :param h: 填充后图像高
+    :param w: 填充后图像宽
+    :param stride: 滑动步长
+    :param target_size: 裁剪尺寸 (w, h)
+    :return: [(topleft_x, topleft_y), ...]
+    """
+    coords = []
+    for j in range(h // stride - 1):
+        for i in range(w // stride - 1):
+            coords.append((i * stride, j * stride))
+    return coords
+
+
+# 低分辨率组织区域预筛选
+def tissue_tiles(image, coords, target_size, reduce=16, s_th=40, p_th=400, small=None):
+    """
+    在缩小 reduce 倍的图像上按饱和度计算组织掩码, 判断每个裁剪块是否需要送入模型
+    阈值含义与 dataset/datacut2.py 一致: 饱和度大于 s_th 的像素数不超过 p_th 的块视为空白玻片或黑色填充
+    :param image: 已填充的整张图像 [H, W, 3]
+    :param coords: tile_coords 返回的坐标列表
+    :param target_size: 裁剪尺寸 (w, h)
+    :param reduce: 预筛选时的缩小倍数
+    :param s_th: 饱和度阈值
+    :param p_th: 原分辨率下的最少组织像素数
+    :param small: 已缩小 reduce 倍的图像, 不为空时 image 可以为 None (如 ScaledPaddedView.thumbnail 的结果)
+    :return: (需要推理的坐标, 跳过的坐标)
+    """
+    target_w, target_h = target_size
+    if small is None:
+        small = cv2.resize(image, (image.shape[1] // reduce, image.shape[0] // reduce),
+                           interpolation=cv2.INTER_AREA)
+    # 饱和度与通道顺序无关, RGB/BGR均可
+    tissue = (cv2.cvtColor(small, cv2.COLOR_RGB2HSV)[..., 1] > s_th).astype(np.int64)
+    # 积分图, 每个裁剪块的组织像素数O(1)求得
+    integral = np.pad(tissue.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+
+    keep, skip = [], []
+    for x, y in coords:
+        x0, y0 = x // reduce, y // reduce
+        x1, y1 = (x + target_w) // reduce, (y + target_h) // reduce
+        count = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+        if count * reduce * reduce > p_th:
+            keep.append((x, y))
+        else:
+            skip.append((x, y))
+    return keep, skip
+
+
+class TileEngine(object):
+    """
+    批量滑窗推理引擎: 将裁剪坐标收集为batch, 每个batch只调用一次模型, 再把结果按坐标返回给调用方写回
+
+    最后一个不满的batch会补零到 batch_size, 保证 tf.function 只按一个输入形状追踪一次
+    """
+
+    def __init__(self, predict_fn, target_size, batch_size=8, channels=3, dtype=np.float32):
+        """
+        :param predict_fn: 输入 [B, H, W, C] dtype 数组, 返回 [B, H, W, ...] 的预测结果
+        :param target_size: 裁剪尺寸 (w, h)
+        :param batch_size: 每次送入模型的裁剪块数量
+        :param channels: 图像通道数
+        :param dtype: 输入缓冲区类型, uint8 时传给模型的数据量只有 float32 的1/4
+        """
+        self.predict_fn = predict_fn
+        self.target_w, self.target_h = target_size
+        self.batch_size = batch_size
+        # 输入缓冲区只分配一次, 所有batch复用
+        self.buffer = np.zeros((batch_size, self.target_h, self.target_w, channels), dtype)
+
+    def run(self, image, coords):
+        """
+        :param image: 已填充的整张图像 [H, W, C]
+        :param coords: tile_coords 返回的坐标列表
+        :return: 生成器, 逐块产出 ((topleft_x, topleft_y), out)
+        """
+        for start in range(0, len(coords), self.batch_size):
+            chunk = coords[start:start + self.batch_size]
+            n = len(chunk)
+            for k, (x, y) in enumerate(chunk):
+                self.buffer[k] = image[y:y + self.target_h, x:x + self.target_w]
+            if n < self.batch_size:
+                self.buffer[n:] = 0
+            out = np.asarray(self.predict_fn(self.buffer))
+            for k in range(n):
+                yield chunk[k], out[k]
@@ -0,0 +1,72 @@
+# 由 sync_helpers.py 从 utils/rle.py 生成, 不要手动修改
+import numpy as np
+
+
+# 行程数组格式化为字符串
+def runs2str(starts, lengths):
+    """
+    :param starts: 1起始的行程起点
+    :param lengths: 行程长度
+    :return: 'start length start length ...'
+    """
+    runs = np.empty(len(starts) * 2, np.int64)
+    runs[0::2], runs[1::2] = starts, lengths
+    return ' '.join(runs.astype(str))
+
+
+# 流式rle编码
+def rle_runs(mask, full_shape=None, band=1024):
+    """
+    按列分块对掩码做列优先(与 mask.T.flatten() 相同)的rle编码, 逐块产出行程, 不生成完整的一维像素数组
+    给定 full_shape 时, 直接编码 mask 按最近邻放大到 full_shape 之后的结果, 无需生成原分辨率掩码,
+    采样位置与 utils.inference.resize_nearest 一致
+    :param mask: [h, w] 0/1 掩码, 可以是 np.memmap
+    :param full_shape: 原分辨率尺寸 (H, W), 为空时等于 mask 尺寸
+    :param band: 每次处理的原分辨率列数
+    :return: 生成器, 逐块产出 (starts, lengths), starts 为1起始
+    """
+    h, w = mask.shape[:2]
+    full_h, full_w = full_shape if full_shape is not None else (h, w)
+    cols = np.arange(full_w, dtype=np.int64) * w // full_w
+    # 低分辨率第 r 行对应原分辨率的起始行: ceil(r * H / h)
+    row_start = (np.arange(h + 1, dtype=np.int64) * full_h + h - 1) // h
+
+    pending = None  # 上一块的最后一个行程, 可能与下一块第一个行程首尾相接
+    for c0 in range(0, full_w, band):
+        block = np.zeros((min(band, full_w - c0), h + 2), np.int8)
+        block[:, 1:-1] = np.asarray(mask[:, cols[c0:c0 + band]]).T > 0
+        diff = np.diff(block, axis=1)
+        s_col, s_row = np.nonzero(diff == 1)
+        _, e_row = np.nonzero(diff == -1)
+
+        offset = (c0 + s_col) * full_h + 1
+        starts = offset + row_start[s_row]
+        ends = offset + row_start[e_row]
+        keep = ends > starts
+        starts, ends = starts[keep], ends[keep]
+        if pending is not None:
+            starts, ends = np.r_[pending[0], starts], np.r_[pending[1], ends]
+        if len(starts) == 0:
+            continue
+
+        # 列尾与下一列列首相接的行程合并为一个
+        join = starts[1:] == ends[:-1]
+        starts, ends = starts[np.r_[True, ~join]], ends[np.r_[~join, True]]
+        pending = starts[-1:], ends[-1:]
+        yield starts[:-1], ends[:-1] - starts[:-1]
+
+    if pending is not None:
+        yield pending[0], pending[1] - pending[0]
+
+
+# 图像转rle编码
+def mask2rle(mask, full_shape=None, band=1024):
+    """
+    流式版本的 mask2rle, 结果与 ' '.join(str(x) for x in runs) 的原实现一致
+    :param mask: [h, w] 0/1 掩码
+    :param full_shape: 原分辨率尺寸 (H, W), 见 rle_runs
+    :param band: 每次处理的原分辨率列数
+    :return: rle字符串
+    """
+    parts = [runs2str(starts, lengths) for starts, lengths in rle_runs(mask, full_shape, band)]
+    return ' '.join(p for p in parts if p)
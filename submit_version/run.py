@@ -3,27 +3,20 @@ import pandas as pd
 import sys
 import cv2
 import numpy as np
-import tifffile as tiff
+import tensorflow as tf
+from tqdm import tqdm
 from tensorflow.keras.models import load_model
 
-IMAGE_SIZE = 384
-
+# 滑窗推理工具随本目录一起提交; inference.py、slide.py、rle.py 由 sync_helpers.py 从 utils/ 生成
+from inference import TileEngine, tile_coords, tissue_tiles
+from slide import SlideReader, ScaledPaddedView
+from rle import mask2rle
 
-# 图像转rle编码
-def mask2rle(img):
-    """
-    Efficient implementation of mask2rle, from @paulorzp
-    https://www.kaggle.com/xhlulu/efficient-mask2rle
-    https://www.kaggle.com/paulorzp/rle-functions-run-lenght-encode-decode
-    --
-    img: numpy array, 1 - mask, 0 - background
-    Returns run length as string formated
-    """
-    pixels = img.T.flatten()
-    pixels = np.pad(pixels, ((1, 1), ))
-    runs = np.where(pixels[1:] != pixels[:-1])[0] + 1
-    runs[1::2] -= runs[::2]
-    return ' '.join(str(x) for x in runs)
+IMAGE_SIZE = 384
+# 与训练时的 cfg.DATASET.NORMALIZE / MEAN / STD 保持一致
+NORMALIZE = False
+MEAN = [0.65459856, 0.48386562, 0.69428385]
+STD = [0.15167958, 0.23584107, 0.13146145]
 
 
 def my_modelname():
@@ -63,68 +56,61 @@ def pred_data(model, path_img_test):
     hstride = stride // 2
     dis_wh = (target_size[0] - stride) // 2
     resize = 0.5
+    batch_size = 8
+    s_th = 40  # saturation blancking threshold
+    p_th = 200 * target_size[0] // 256  # threshold for the minimum number of pixels
 
     test = pd.DataFrame(columns=['id', 'predicted'])
 
+    @tf.function
     def tta_interfence(y):
-        y = y / 255.
+        y = tf.cast(y, tf.float32) / 255.
+        if NORMALIZE:
+            y = (y - MEAN) / STD
         out_ = model(y, training=False)
         # out_, _, _, _, _ = model(y, training=False)
-        return out_
+        return tf.cast(tf.argmax(tf.math.softmax(out_), axis=-1), tf.uint8)
+
+    engine = TileEngine(lambda y: tta_interfence(tf.convert_to_tensor(y)), target_size, batch_size=batch_size)
 
     for img in os.listdir(tiff_dir):
         if not img.endswith('tiff'):
             continue
         image_path = os.path.join(tiff_dir, img)
-        image = tiff.imread(image_path)
-        image = np.asarray(image)
-        if len(image.shape) == 5:
-            image = np.transpose(image.squeeze(), (1, 2, 0))
-        hh, ww = image.shape[0], image.shape[1]
-        image = cv2.resize(image, (int(image.shape[1] * resize), int(image.shape[0] * resize)))
+        # 按窗口惰性读取切片, 不把整张TIFF读入内存; 块缓存容纳一行裁剪块, tile_coords 按行优先顺序读取
+        slide = SlideReader(image_path, cache_rows=int(np.ceil(target_size[1] / resize)))
+        hh, ww = slide.shape[0], slide.shape[1]
 
         # 填充外边界至步长整数倍
-        h, w = image.shape[0], image.shape[1]
+        h, w = int(hh * resize), int(ww * resize)
         target_w, target_h = target_size
         new_w = (w // target_w) * target_w if (w % target_w == 0) else (w // target_w + 1) * target_w
         new_h = (h // target_h) * target_h if (h % target_h == 0) else (h // target_h + 1) * target_h
-        image = cv2.copyMakeBorder(image, 0, new_h - h, 0, new_w - w, cv2.BORDER_CONSTANT, 0)
 
         # 填充1/2 stride长度的外边框
-        new_w, new_h = image.shape[1] + stride, image.shape[0] + stride
-        image = cv2.copyMakeBorder(image, stride // 2, stride // 2, stride // 2, stride // 2, cv2.BORDER_CONSTANT, 0)
+        new_w, new_h = new_w + stride, new_h + stride
+        image = ScaledPaddedView(slide, resize, (new_h, new_w), stride // 2)
         png = np.zeros((new_h, new_w), np.uint8)
-        image_old = np.zeros((new_h, new_w, 3), np.uint8)
 
         h_, w_ = image.shape[0], image.shape[1]
 
-        for i in tqdm(range(w_ // stride - 1)):
-            for j in range(h_ // stride - 1):
-                topleft_x = i * stride
-                topleft_y = j * stride
-                buttomright_y = topleft_y + target_h
-                buttomright_x = topleft_x + target_h
-                crop_image = image[topleft_y:buttomright_y, topleft_x:buttomright_x]
-                if crop_image.shape[:2] != (target_h, target_h):
-                    print(topleft_x, topleft_y, crop_image.shape)
-
-                image_old[topleft_y + dis_wh:buttomright_y - dis_wh, topleft_x + dis_wh:buttomright_x - dis_wh] = \
-                    crop_image[dis_wh:target_size[0] - dis_wh, dis_wh:target_size[1] - dis_wh]
-
-                crop_image = tf.cast(tf.expand_dims(crop_image, axis=0), dtype=tf.float32)
-                out = tta_interfence(crop_image)
-                out = np.squeeze(np.argmax(tf.math.softmax(out), axis=-1))
-                # cv2.imwrite(test_mask_path + img[:-4] + "_" + str(i) + str(j) + ".jpg", out * 255)
+        coords = tile_coords(h_, w_, stride, target_size)
+        # 空白玻片和黑色填充区域直接视为背景, 不送入模型
+        coords, skipped = tissue_tiles(None, coords, target_size, s_th=s_th, p_th=p_th, small=image.thumbnail(16))
+        print('{}: inferred {} tiles, skipped {} tiles'.format(img, len(coords), len(skipped)))
 
-                png[topleft_y + dis_wh:buttomright_y - dis_wh, topleft_x + dis_wh:buttomright_x - dis_wh] = \
-                    out[dis_wh:target_size[0] - dis_wh, dis_wh:target_size[1] - dis_wh]
+        for (topleft_x, topleft_y), out in tqdm(engine.run(image, coords), total=len(coords)):
+            buttomright_y = topleft_y + target_h
+            buttomright_x = topleft_x + target_w
+            png[topleft_y + dis_wh:buttomright_y - dis_wh, topleft_x + dis_wh:buttomright_x - dis_wh] = \
+                out[dis_wh:target_size[0] - dis_wh, dis_wh:target_size[1] - dis_wh]
 
         png = png[hstride:new_h - hstride, hstride:new_w - hstride]
         png = png[:h, :w]
-        # png = png * 255
-        png = cv2.resize(png, (ww, hh), cv2.INTER_NEAREST)
+        slide.close()
 
-        encs = mask2rle(png)
+        # 直接由推理分辨率的掩码按列分块编码, 不生成原分辨率掩码
+        encs = mask2rle(png, full_shape=(hh, ww))
         new = pd.DataFrame({'id': [img], 'predicted': [encs]}, index=[1])
         test = test.append(new, ignore_index=True)
 
@@ -0,0 +1,179 @@
+# 由 sync_helpers.py 从 utils/slide.py 生成, 不要手动修改
+import numpy as np
+import cv2
+import tifffile as tiff
+import zarr
+
+
+# 带零填充的窗口裁剪
+def crop_pad(array, x, y, w, h):
+    """
+    从 array 中取 (x, y, w, h) 窗口, 超出边界的部分填0
+    :param array: [H, W, ...] numpy数组或zarr数组
+    :return: [h, w, ...]
+    """
+    out = np.zeros((h, w) + tuple(array.shape[2:]), array.dtype)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, array.shape[1]), min(y + h, array.shape[0])
+    if x1 > x0 and y1 > y0:
+        out[y0 - y:y1 - y, x0 - x:x1 - x] = array[y0:y1, x0:x1]
+    return out
+
+
+class _HWCLevel(object):
+    """
+    把 tifffile 的 zarr 数组统一包装成 [H, W, C] 的切片视图, 兼容 'YXS' 和 5维 (1, 1, 3, H, W) 等存储方式
+    """
+
+    def __init__(self, array, axes):
+        self.array = array
+        self.axes = axes
+        self.y_axis, self.x_axis = axes.index('Y'), axes.index('X')
+        # 除Y、X外尺寸大于1的轴视为通道轴, 其余单维轴直接取0
+        self.c_axis = None
+        for i, size in enumerate(array.shape):
+            if i not in (self.y_axis, self.x_axis) and size > 1:
+                self.c_axis = i
+        channels = array.shape[self.c_axis] if self.c_axis is not None else 1
+        self.shape = (array.shape[self.y_axis], array.shape[self.x_axis], channels)
+        self.dtype = array.dtype
+
+    def __getitem__(self, item):
+        ys, xs = item[0], item[1]
+        index = []
+        for i, size in enumerate(self.array.shape):
+            if i == self.y_axis:
+                index.append(ys)
+            elif i == self.x_axis:
+                index.append(xs)
+            elif i == self.c_axis:
+                index.append(slice(None))
+            else:
+                index.append(0)
+        out = self.array[tuple(index)]
+        if self.c_axis is None:
+            return out[..., None]
+        # 剩余轴按原始顺序排列, 通道轴在Y之前时需要移到最后
+        if self.c_axis < self.y_axis:
+            out = np.moveaxis(out, 0, -1)
+        return out
+
+
+class SlideReader(object):
+    """
+    基于 tifffile + zarr 的切片读取器, 按需读取任意窗口, 不把整张TIFF读入内存
+
+    条带(strip)存储或未分块的TIFF每个 zarr 块是整行宽的条带, 读取任意小窗口都要解码整条;
+    解码后的块保存在 zarr.LRUStoreCache 中, 大小足够容纳 cache_rows 行, 按行优先顺序读取同一行的裁剪块时
+    每个条带只解码一次
+
+    用法:
+        with SlideReader(path) as slide:
+            tile = slide.read(x, y, w, h)              # 原分辨率窗口
+            thumb = slide.read(0, 0, W, H, reduce=16)  # 缩小16倍的整图
+    """
+
+    def __init__(self, path, cache_rows=1024):
+        """
+        :param path: TIFF 路径
+        :param cache_rows: 块缓存能容纳的原分辨率行数(另加一个块的行数), 应不小于一行裁剪块的高度; 0 表示不缓存
+        """
+        self.tif = tiff.TiffFile(path)
+        series = self.tif.series[0]
+        store = series.aszarr()
+        if cache_rows > 0:
+            level0 = zarr.open(store, mode='r')
+            level0 = level0['0'] if isinstance(level0, zarr.Group) else level0
+            y_axis = series.axes.index('Y')
+            row_bytes = level0.nbytes // level0.shape[y_axis]
+            store = zarr.LRUStoreCache(store, max_size=(cache_rows + level0.chunks[y_axis]) * row_bytes)
+        store = zarr.open(store, mode='r')
+        arrays = [store[str(i)] for i in range(len(store))] if isinstance(store, zarr.Group) else [store]
+        self.levels = [_HWCLevel(a, series.axes) for a in arrays]
+        self.shape = self.levels[0].shape
+        # 各金字塔层相对原图的缩小倍数
+        self.factors = [self.shape[0] // level.shape[0] for level in self.levels]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.tif.close()
+
+    def read(self, x, y, w, h, reduce=1, band=4096):
+        """
+        读取原分辨率坐标系下的 (x, y, w, h) 窗口, 超出切片的部分填0, 并缩小 reduce 倍
+        有现成的金字塔层时直接从该层读取, 否则按行分块读取后用 INTER_AREA 缩小, 峰值内存只与 band 有关
+        :param reduce: 整数缩小倍数
+        :param band: 分块读取时每块的原分辨率行数
+        :return: [h // reduce, w // reduce, C] uint8
+        """
+        # 选择能整除 reduce 的最粗金字塔层
+        level_idx = max(i for i, f in enumerate(self.factors) if reduce % f == 0)
+        factor = self.factors[level_idx]
+        level = self.levels[level_idx]
+        x, y, w, h, reduce = x // factor, y // factor, w // factor, h // factor, reduce // factor
+        if reduce == 1:
+            return crop_pad(level, x, y, w, h)
+
+        out = np.zeros((h // reduce, w // reduce, self.shape[2]), level.dtype)
+        band = max(band // reduce, 1) * reduce
+        for r0 in range(0, (h // reduce) * reduce, band):
+            rows = min(band, (h // reduce) * reduce - r0)
+            chunk = crop_pad(level, x, y + r0, (w // reduce) * reduce, rows)
+            small = cv2.resize(chunk, (w // reduce, rows // reduce), interpolation=cv2.INTER_AREA)
+            out[r0 // reduce:(r0 + rows) // reduce] = small.reshape(rows // reduce, w // reduce, -1)
+        return out
+
+
+class ScaledPaddedView(object):
+    """
+    惰性模拟 eval.py 中 "整图缩放 resize 倍 -> 右下填充到 target_size 整数倍 -> 四周填充 pad" 之后的图像,
+    只在切片访问时从 SlideReader 读取对应窗口并缩放, 可直接交给 TileEngine 使用
+    """
+
+    def __init__(self, slide, resize, padded_shape, pad):
+        """
+        :param slide: SlideReader
+        :param resize: 缩放比例
+        :param padded_shape: 填充后图像尺寸 (H, W)
+        :param pad: 四周填充宽度
+        """
+        self.slide = slide
+        self.resize = resize
+        self.pad = pad
+        self.h = int(slide.shape[0] * resize)
+        self.w = int(slide.shape[1] * resize)
+        self.shape = (padded_shape[0], padded_shape[1], slide.shape[2])
+
+    def __getitem__(self, item):
+        ys, xs = item[0], item[1]
+        y0, y1 = ys.start - self.pad, ys.stop - self.pad
+        x0, x1 = xs.start - self.pad, xs.stop - self.pad
+        out = np.zeros((y1 - y0, x1 - x0, self.shape[2]), np.uint8)
+        # 只读取与缩放后图像有交集的部分, 填充区域保持为0
+        cy0, cy1, cx0, cx1 = max(y0, 0), min(y1, self.h), max(x0, 0), min(x1, self.w)
+        if cy1 <= cy0 or cx1 <= cx0:
+            return out
+        sx0, sy0 = int(cx0 / self.resize), int(cy0 / self.resize)
+        sx1, sy1 = int(np.ceil(cx1 / self.resize)), int(np.ceil(cy1 / self.resize))
+        window = self.slide.read(sx0, sy0, sx1 - sx0, sy1 - sy0)
+        window = cv2.resize(window, (cx1 - cx0, cy1 - cy0), interpolation=cv2.INTER_AREA)
+        out[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = window.reshape(cy1 - cy0, cx1 - cx0, -1)
+        return out
+
+    def thumbnail(self, reduce):
+        """
+        :param reduce: 相对填充后图像的缩小倍数
+        :return: [H // reduce, W // reduce, C] 低分辨率填充图像, 用于组织区域预筛选
+        """
+        factor = max(int(round(reduce / self.resize)), 1)
+        small = self.slide.read(0, 0, self.slide.shape[1], self.slide.shape[0], reduce=factor)
+        out = np.zeros((self.shape[0] // reduce, self.shape[1] // reduce, self.shape[2]), np.uint8)
+        p = self.pad // reduce
+        hh, ww = min(small.shape[0], out.shape[0] - p), min(small.shape[1], out.shape[1] - p)
+        out[p:p + hh, p:p + ww] = small[:hh, :ww]
+        return out
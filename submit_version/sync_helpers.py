@@ -0,0 +1,64 @@
+"""
+    从 utils/ 生成 run.py 所需的滑窗推理工具副本, 只保留 run.py 用到的定义, 使本目录可以单独提交运行
+    修改 utils/inference.py、utils/slide.py、utils/rle.py 后运行: python submit_version/sync_helpers.py
+    tests/test_submit_version.py 检查副本与 utils/ 是否一致
+"""
+import os
+import ast
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 模块名: 需要保留的顶层定义(包括被依赖的定义)
+HELPERS = {
+    'inference': ['tile_coords', 'tissue_tiles', 'TileEngine'],
+    'slide': ['crop_pad', '_HWCLevel', 'SlideReader', 'ScaledPaddedView'],
+    'rle': ['runs2str', 'rle_runs', 'mask2rle'],
+}
+
+
+# 生成单个模块副本的内容
+def render(module):
+    """
+    保留源文件的全部 import 和 HELPERS 中列出的函数/类(连同其上方的注释行), 顺序与源文件一致
+    :return: 副本文件内容
+    """
+    with open(os.path.join(ROOT, 'utils', module + '.py'), encoding='utf-8') as f:
+        source = f.read()
+    lines = source.splitlines(keepends=True)
+    imports, blocks = [], []
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            imports.append(''.join(lines[node.lineno - 1:node.end_lineno]))
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in HELPERS[module]:
+            start = node.lineno - 1
+            while start > 0 and lines[start - 1].startswith('#'):
+                start -= 1
+            blocks.append(''.join(lines[start:node.end_lineno]))
+    header = '# 由 sync_helpers.py 从 utils/{}.py 生成, 不要手动修改\n'.format(module)
+    return header + ''.join(imports) + '\n\n' + '\n\n'.join(blocks)
+
+
+def main(argv):
+    """
+    --check: 只检查, 副本过期时返回1
+    """
+    stale = []
+    for module in HELPERS:
+        path = os.path.join(HERE, module + '.py')
+        content = render(module)
+        current = open(path, encoding='utf-8').read() if os.path.isfile(path) else None
+        if current == content:
+            continue
+        stale.append(path)
+        if '--check' not in argv:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+    for path in stale:
+        print(('stale: ' if '--check' in argv else 'updated: ') + path)
+    return 1 if stale and '--check' in argv else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,51 @@
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+tf = pytest.importorskip('tensorflow')
+from utils.score import fast_hist, confusion_matrix, segmentation_metrics, SegmentationMetric
+
+
+def _sample(n, shape=(2, 64, 64), seed=0):
+    rng = np.random.RandomState(seed)
+    label = rng.randint(0, n, shape).astype(np.uint8)
+    # 填充区域的标签为255, 应被忽略
+    label[:, :4] = 255
+    predict = rng.randint(0, n, shape).astype(np.int64)
+    return label, predict
+
+
+@pytest.mark.parametrize('n', [2, 3])
+def test_confusion_matrix_matches_fast_hist(n):
+    label, predict = _sample(n)
+    expected = fast_hist(label.reshape(-1), predict.reshape(-1), n)
+    # 与训练步中相同: uint8 标签 [B, H, W, 1], argmax 得到的 int64 预测
+    result = tf.function(confusion_matrix)(tf.constant(label[..., None]), tf.constant(predict), n)
+    assert result.dtype == tf.int64
+    np.testing.assert_array_equal(result.numpy(), expected)
+
+
+@pytest.mark.parametrize('n', [2, 3])
+def test_segmentation_metrics_match_numpy(n):
+    label, predict = _sample(n, seed=1)
+    metric = SegmentationMetric(n)
+    metric.addConfusionMatrix(fast_hist(label.reshape(-1), predict.reshape(-1), n))
+    result = tf.function(segmentation_metrics)(confusion_matrix(label, predict, n))
+    np.testing.assert_allclose(result['PA'].numpy(), metric.pixelAccuracy())
+    np.testing.assert_allclose(result['mPA'].numpy(), metric.meanPixelAccuracy())
+    np.testing.assert_allclose(result['mIoU'].numpy(), metric.mIoU())
+    np.testing.assert_allclose(result['dice'].numpy(), metric.dice())
+    np.testing.assert_allclose(result['IoU'].numpy()[1], metric.IoU(1))
+
+
+def test_segmentation_metrics_skip_absent_classes():
+    # 第2类既没有标注也没有预测, 不参与平均
+    label = np.array([0, 0, 1, 1])
+    predict = np.array([0, 1, 1, 1])
+    metric = SegmentationMetric(3)
+    metric.addConfusionMatrix(fast_hist(label, predict, 3))
+    result = segmentation_metrics(confusion_matrix(label, predict, 3))
+    assert np.isnan(result['IoU'].numpy()[2])
+    np.testing.assert_allclose(result['mIoU'].numpy(), metric.mIoU())
+    np.testing.assert_allclose(result['dice'].numpy(), metric.dice())
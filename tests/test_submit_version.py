@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'submit_version'))
+import sync_helpers
+
+
+# submit_version/ 下的工具副本必须与 utils/ 一致, 修改 utils/ 后运行 python submit_version/sync_helpers.py
+@pytest.mark.parametrize('module', sorted(sync_helpers.HELPERS))
+def test_helpers_in_sync(module):
+    with open(os.path.join(sync_helpers.HERE, module + '.py'), encoding='utf-8') as f:
+        assert f.read() == sync_helpers.render(module)
@@ -1,20 +1,26 @@
 import tensorflow as tf
 import pathlib
-from utils.data_aug import get_dataset
+from utils.data_aug import get_dataset, normalize_image, read_manifest
 from utils.util import learning_rate_config, config_optimizer, add_regularization
-from utils.score import SegmentationMetric
+from utils.score import SegmentationMetric, confusion_matrix, segmentation_metrics
 from utils.visualization import vis_segmentation
 from utils.loss import get_loss
 from models.model_summary import create_model
 import numpy as np
 from tqdm import tqdm
 from config import cfg
-from utils.util import set_device, ckpt_manager
+from utils.util import set_device, set_mixed_precision, ckpt_manager, get_strategy, is_chief
+from utils.inference import peak_rss_mb
+import math
+import time
 from utils.logger import create_logger
 
 
 def train():
     set_device()
+    # 分布式策略需要在其它 TensorFlow 操作之前创建
+    strategy = get_strategy(cfg)
+    chief = is_chief(strategy)
     output_dir = pathlib.Path(cfg.LOG_DIR)
     output_dir.mkdir(exist_ok=True, parents=True)
     logger = create_logger(name=__name__,
@@ -26,63 +32,144 @@ def train():
 
     for batch, (images, labels) in enumerate(train_dataset):
         for i in range(cfg.TRAIN.BATCH_SIZE):
-            img = np.array(images[i, :, :, :] * 255).astype(np.int64)
+            img = np.array(tf.image.convert_image_dtype(images[i, :, :, :], tf.uint8)).astype(np.int64)
             label = np.array(labels[i, :, :, 0]).astype(np.int64)
             vis_segmentation(img, label, label_names=cfg.DATASET.LABELS)
 
-    # 模型搭建和损失函数配置
-    model = create_model(cfg, name=cfg.MODEL_NAME, backbone=cfg.BACKBONE_NAME)
-    model = add_regularization(model, tf.keras.regularizers.l2(cfg.LOSS.WEIGHT_DECAY))
-    model.summary()
-
-    loss = get_loss(cfg, cfg.LOSS.TYPE)
-
-    # 优化器和学习率配置
-    lr = tf.Variable(cfg.SCHEDULER.LR_INIT)
-    learning_rate = learning_rate_config(cfg)
+    # 每个epoch和每次验证都运行固定步数: 多机训练时各 worker 分到的样本数不同, 按数据集结束判断会使
+    # 先结束的 worker 退出循环, 其余 worker 停在集合通信(all-reduce)上; 因此数据集无限重复, 步数由全局batch计算
+    steps_per_epoch = math.ceil(cfg.DATASET.NUM_TRAIN / cfg.TRAIN.BATCH_SIZE)
+    num_val = cfg.DATASET.NUM_VAL or read_manifest(cfg.DATASET.VAL_DATA).get('num_records', 0)
+    if num_val:
+        val_steps = math.ceil(num_val / cfg.DATASET.VAL_BATCH_SIZE)
+    else:
+        # 没有 manifest 时完整迭代一遍计数, 同时填充验证集缓存
+        val_steps = int(val_dataset.reduce(np.int64(0), lambda n, _: n + 1))
 
-    # warmup策略
-    def lr_with_warmup(global_steps):
-        lr_ = tf.cond(tf.less(global_steps, cfg.SCHEDULER.WARMUP_STEPS),
-                      lambda: cfg.SCHEDULER.LR_INIT * tf.cast((global_steps + 1) / cfg.SCHEDULER.WARMUP_STEPS, tf.float32),
-                      lambda: tf.maximum(learning_rate(global_steps - cfg.SCHEDULER.WARMUP_STEPS), cfg.SCHEDULER.LR_LOWER_BOUND))
-        return lr_
+    # cfg.TRAIN.BATCH_SIZE 为全局batch, 由各副本平分
+    train_iterator = iter(strategy.experimental_distribute_dataset(train_dataset.repeat()))
+    val_iterator = iter(strategy.experimental_distribute_dataset(val_dataset.repeat()))
 
-    optimizer = config_optimizer(cfg, learning_rate=lr)
-
-    # 模型保存与恢复
-    manager, ckpt = ckpt_manager(cfg, model, logger, optimizer)
+    # 模型搭建和损失函数配置
+    set_mixed_precision(cfg)
+    # 模型、优化器及其它变量都需要在 strategy.scope() 中创建
+    with strategy.scope():
+        model = create_model(cfg, name=cfg.MODEL_NAME, backbone=cfg.BACKBONE_NAME)
+        model = add_regularization(model, tf.keras.regularizers.l2(cfg.LOSS.WEIGHT_DECAY))
+        model.summary()
+
+        loss = get_loss(cfg, cfg.LOSS.TYPE)
+
+        # 优化器和学习率配置
+        lr = tf.Variable(cfg.SCHEDULER.LR_INIT)
+        learning_rate = learning_rate_config(cfg)
+
+        # warmup策略, global_steps 为优化器更新次数, 梯度累加时不等于 micro-batch 数
+        def lr_with_warmup(global_steps):
+            lr_ = tf.cond(tf.less(global_steps, cfg.SCHEDULER.WARMUP_STEPS),
+                          lambda: cfg.SCHEDULER.LR_INIT * tf.cast((global_steps + 1) / cfg.SCHEDULER.WARMUP_STEPS, tf.float32),
+                          lambda: tf.maximum(learning_rate(global_steps - cfg.SCHEDULER.WARMUP_STEPS), cfg.SCHEDULER.LR_LOWER_BOUND))
+            return lr_
+
+        optimizer = config_optimizer(cfg, learning_rate=lr)
+        loss_scale = cfg.TRAIN.MIXED_PRECISION == 'mixed_float16'
+
+        # 模型保存与恢复, 多机训练时所有 worker 都要保存, 非 chief 写入临时目录
+        manager, ckpt = ckpt_manager(cfg, model, logger, optimizer,
+                                     directory=None if chief else cfg.CKPT_DIR + '/workertemp_{}'.format(
+                                         strategy.cluster_resolver.task_id))
+
+        # 梯度累加: 每 accum_steps 个 micro-batch 更新一次参数, 有效batch为 BATCH_SIZE * ACCUM_STEPS
+        accum_steps = cfg.TRAIN.ACCUM_STEPS
+        if accum_steps > 1:
+            # 累加变量只分配一次, 与可训练参数一一对应; 每个副本累加自己的梯度, 更新参数时由优化器跨副本求和
+            accum_grads = [tf.Variable(tf.zeros_like(v), trainable=False,
+                                       synchronization=tf.VariableSynchronization.ON_READ,
+                                       aggregation=tf.VariableAggregation.SUM) for v in model.trainable_variables]
+        micro_step = 0
+
+        # 训练集混淆矩阵在训练步内累加, 每个epoch只读取一次; 各副本分别累加, 读取时求和
+        train_cm = tf.Variable(tf.zeros([cfg.DATASET.N_CLASSES] * 2, tf.int64), trainable=False,
+                               synchronization=tf.VariableSynchronization.ON_READ,
+                               aggregation=tf.VariableAggregation.SUM)
 
     # 训练与验证静态图
-    @tf.function
-    def train_one_batch(x, y):
+    # 单个副本上的训练步, 损失除以副本数, 优化器跨副本求和后即为全局batch的平均梯度
+    def replica_train_step(x, y, update_cm):
+        x = normalize_image(x, cfg)
         with tf.GradientTape() as tape:
             # 1、计算模型输出和损失
             pred_o = model(x, training=True)
             # pred_o, l2, l3, l4, l5 = model(x, training=True)
-            regularization_loss_out = tf.reduce_sum(model.losses)
+            regularization_loss_out = tf.nn.scale_regularization_loss(tf.reduce_sum(model.losses))
             # seg_loss_out = loss(y, pred_o) + 0.1 * (loss(y, l2) + loss(y, l3) + loss(y, l4) + loss(y, l5))
-            seg_loss_out = loss(y, pred_o)
+            seg_loss_out = loss(y, pred_o) / strategy.num_replicas_in_sync
             total_loss_out = seg_loss_out + regularization_loss_out
+            # float16 混合精度时先放大损失, 求出梯度后再缩小
+            scaled_loss_out = optimizer.get_scaled_loss(total_loss_out) if loss_scale else total_loss_out
         # 计算梯度以及更新梯度, 固定用法
-        grads = tape.gradient(total_loss_out, model.trainable_variables)
-        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        grads = tape.gradient(scaled_loss_out, model.trainable_variables)
+        if loss_scale:
+            grads = optimizer.get_unscaled_gradients(grads)
+        if accum_steps > 1:
+            # 累加 micro-batch 的平均梯度, 由 apply_accumulated 更新参数
+            for accum_grad, grad in zip(accum_grads, grads):
+                if grad is not None:
+                    accum_grad.assign_add(grad / accum_steps)
+        else:
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        if update_cm:
+            train_cm.assign_add(confusion_matrix(y, tf.argmax(pred_o, axis=-1), cfg.DATASET.N_CLASSES))
+
+        return total_loss_out, seg_loss_out
+
+    # 各副本的损失求和后为全局平均损失; update_cm 为 Python 布尔值, 两种取值各追踪一个静态图,
+    # 只有需要计算训练集精度的epoch才在训练步内累加混淆矩阵
+    @tf.function
+    def train_one_batch(x, y, update_cm):
+        total_loss_out, seg_loss_out = strategy.run(lambda x_, y_: replica_train_step(x_, y_, update_cm), args=(x, y))
+        total_loss_out = strategy.reduce(tf.distribute.ReduceOp.SUM, total_loss_out, axis=None)
+        seg_loss_out = strategy.reduce(tf.distribute.ReduceOp.SUM, seg_loss_out, axis=None)
+        return total_loss_out, seg_loss_out
+
+    # 同步于读取的变量只能在副本内清零
+    @tf.function
+    def reset_train_cm():
+        strategy.run(lambda: train_cm.assign(tf.zeros_like(train_cm)))
 
-        return total_loss_out, seg_loss_out, pred_o
+    # 每 accum_steps 个 micro-batch 更新一次参数并清零累加变量, optimizer.iterations 只在这里增加
+    def replica_apply_accumulated():
+        optimizer.apply_gradients(zip([g.read_value() for g in accum_grads], model.trainable_variables))
+        for accum_grad in accum_grads:
+            accum_grad.assign(tf.zeros_like(accum_grad))
 
     @tf.function
-    def val_one_batch(x, y):
+    def apply_accumulated():
+        strategy.run(replica_apply_accumulated)
+
+    # 单个副本上的验证步, 只返回该batch的混淆矩阵
+    def replica_val_step(x, y):
+        x = normalize_image(x, cfg)
         # pred_o, _, _, _, _ = model(x, training=False)
         pred_o = model(x, training=False)
-        return pred_o
+        return confusion_matrix(y, tf.argmax(pred_o, axis=-1), cfg.DATASET.N_CLASSES)
+
+    # 整个验证集在一个静态图内完成, 混淆矩阵在设备上累加, 一次调用返回全部指标;
+    # 验证集在batch之后重复, 单设备时 val_steps 个batch恰好是完整的一遍
+    @tf.function
+    def validate(iterator):
+        val_cm = tf.zeros([cfg.DATASET.N_CLASSES] * 2, tf.int64)
+        for _ in tf.range(val_steps):
+            images_batch, labels_batch = next(iterator)
+            batch_cm = strategy.run(replica_val_step, args=(images_batch, labels_batch))
+            val_cm += strategy.reduce(tf.distribute.ReduceOp.SUM, batch_cm, axis=None)
+        return segmentation_metrics(val_cm)
 
     # region # 记录器和评价指标
-    summary_writer = tf.summary.create_file_writer(cfg.LOG_DIR)
+    summary_writer = tf.summary.create_file_writer(cfg.LOG_DIR) if chief else tf.summary.create_noop_writer()
     # tf.summary.trace_on(profiler=True)  # 开启Trace（可选）
     # 评价指标
-    val_metric = SegmentationMetric(cfg.DATASET.N_CLASSES)
     train_metric = SegmentationMetric(cfg.DATASET.N_CLASSES)
-    val_metric.reset()
     train_metric.reset()
     # endregion
 
@@ -91,51 +178,64 @@ def train():
         # region # 训练集
         ckpt.step.assign_add(1)
         lr.assign(lr_with_warmup(optimizer.iterations))  # 必须使用assign才能改变optimizer的lr的值，否则，是个固定值
-        for batch, (images_batch, labels_batch) in tqdm(enumerate(train_dataset)):
-            total_loss, seg_loss, train_pred = train_one_batch(images_batch, labels_batch)
-            # 计算训练集精度
-            if int(ckpt.step) % cfg.TRAIN.SNAP_SHOT == 1:
-                train_out = np.argmax(train_pred, axis=-1)
-                for i in range(labels_batch.shape[0]):
-                    train_label = np.array(labels_batch[i, :, :, 0]).astype(np.int64)
-                    train_metric.addBatch(train_label, train_out[i, :, :])
+        step_time, num_steps = 0., 0
+        snapshot = int(ckpt.step) % cfg.TRAIN.SNAP_SHOT == 1
+        if snapshot:
+            reset_train_cm()
+        for batch in tqdm(range(steps_per_epoch)):
+            images_batch, labels_batch = next(train_iterator)
+            start = time.time()
+            total_loss, seg_loss = train_one_batch(images_batch, labels_batch, snapshot)
+            micro_step += 1
+            if accum_steps > 1 and micro_step % accum_steps == 0:
+                apply_accumulated()
+            # 第一个batch包含静态图追踪, 不计入单步耗时
+            if batch > 0:
+                total_loss.numpy()
+                step_time += time.time() - start
+                num_steps += 1
             # if epoch > 200:
             with summary_writer.as_default():  # 指定记录器
                 tf.summary.scalar("train/total_losses", total_loss, step=optimizer.iterations)  # 将当前损失函数的值写入记录器
                 tf.summary.scalar("train/segmentation_loss_loss", seg_loss, step=optimizer.iterations)
                 tf.summary.scalar("train/learning_rate", lr, step=optimizer.iterations)
+        # 单步耗时和内存, 用于对比 float32 与混合精度
+        logger.info('__EPOCH_{}__: STEP_TIME: {:.1f} ms, PEAK_RSS: {:.0f} MB, PRECISION: {}'
+                    .format(int(ckpt.step), 1000. * step_time / max(num_steps, 1), peak_rss_mb(),
+                            cfg.TRAIN.MIXED_PRECISION or 'float32'))
+        # 计算训练集精度, 只在累加了混淆矩阵的epoch从设备读取一次
+        if snapshot:
+            train_metric.addConfusionMatrix(tf.convert_to_tensor(train_cm))
         # endregion
 
         # region # 验证集
-        if int(ckpt.step) % cfg.TRAIN.SNAP_SHOT == 1:
+        if snapshot:
             # ----------------------------------------------验证集验证--------------------------------------------------------
-            for batch, (images_batch, labels_batch) in tqdm(enumerate(val_dataset)):
-                out = val_one_batch(images_batch, labels_batch)
-                out = np.squeeze(np.argmax(out, axis=-1))
-                labels_batch = np.array(labels_batch[0, :, :, 0]).astype(np.int64)
-                val_metric.addBatch(labels_batch, out)
+            val_metric = {k: v.numpy() for k, v in validate(val_iterator).items()}
 
             with summary_writer.as_default():
-                tf.summary.scalar("val_metric/mPA", val_metric.meanPixelAccuracy(), step=int(ckpt.step))
-                tf.summary.scalar("val_metric/dice", val_metric.dice(), step=int(ckpt.step))
-                tf.summary.scalar("val_metric/IoU1", val_metric.IoU(1), step=int(ckpt.step))
-                tf.summary.scalar("val_metric/mIoU", val_metric.mIoU(), step=int(ckpt.step))
+                tf.summary.scalar("val_metric/mPA", val_metric['mPA'], step=int(ckpt.step))
+                tf.summary.scalar("val_metric/dice", val_metric['dice'], step=int(ckpt.step))
+                tf.summary.scalar("val_metric/IoU1", val_metric['IoU'][1], step=int(ckpt.step))
+                tf.summary.scalar("val_metric/mIoU", val_metric['mIoU'], step=int(ckpt.step))
                 tf.summary.scalar("train_metric/mPA", train_metric.meanPixelAccuracy(), step=int(ckpt.step))
                 tf.summary.scalar("train_metric/mIoU", train_metric.mIoU(), step=int(ckpt.step))
                 tf.summary.scalar("train_metric/dice", train_metric.dice(), step=int(ckpt.step))
                 tf.summary.scalar("train_metric/IoU1", train_metric.IoU(1), step=int(ckpt.step))
-                # VAL_PA = val_metric.meanPixelAccuracy()
+                # VAL_PA = val_metric['mPA']
                 logger.info('__EPOCH_{}__: TRAIN_mIoU: {:.5f}, TRAIN_mPA: {:.5f}, TRAIN_dice: {:.5f}; '
                             'VAL_mIoU: {:.5f}, VAL_mPA: {:.5f}, VAL_dice: {:.5f}'
                             .format(int(ckpt.step), train_metric.mIoU(), train_metric.meanPixelAccuracy(), train_metric.dice(),
-                                    val_metric.mIoU(), val_metric.meanPixelAccuracy(), val_metric.dice()))
+                                    val_metric['mIoU'], val_metric['mPA'], val_metric['dice']))
             train_metric.reset()
-            val_metric.reset()
         # endregion
 
         # region # 模型保存
         # 使用CheckpointManager保存模型参数到文件并自定义编号
         manager.save(checkpoint_number=int(ckpt.step))
+        # 非 chief 的保存只是为了参与集合通信, 保存后删除临时目录
+        if not chief:
+            tf.io.gfile.rmtree(manager.directory)
 
         # model.save_weights(.FLAGSckpt_dir + '/BiseNetv2.tf')
         # if TRA_PA >= 0.97 or VAL_PA >= 0.97:
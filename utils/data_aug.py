@@ -1,10 +1,14 @@
+import os
+import re
+import json
 import tensorflow as tf
 import numpy as np
 from utils.imaug.Resize import StepScaleCrop, random_resizedcrop, random_zoom
 from utils.imaug.Cutout import random_cutout
-from utils.imaug.GridMask import gridmask
+from utils.imaug.GridMask import gridmask, batch_gridmask
 from utils.imaug.CutMix import cutmix
 from utils.imaug.RnadomErasing import random_erasing
+from utils.imaug.BatchAug import batch_adjust_color, batch_random_flip, batch_scale_crop
 
 
 # 基础数据增广,颜色方面（调节对比度，调节亮度，调节Hue，添加饱和度，添加高斯噪声等
@@ -27,32 +31,77 @@ def adjust_color(img, mask):
     return img, mask
 
 
-# 随机翻转
+# 随机翻转, 图像和掩码使用同一次随机采样
 @tf.function
 def random_flip(img, mask, vertical=False):
-    img = tf.image.random_flip_left_right(img)
+    flip = tf.random.uniform([]) < 0.5
+    img = tf.where(flip, tf.reverse(img, axis=[1]), img)
+    mask = tf.where(flip, tf.reverse(mask, axis=[1]), mask)
     if vertical is True:
-        img = tf.image.random_flip_up_down(img)
+        flip = tf.random.uniform([]) < 0.5
+        img = tf.where(flip, tf.reverse(img, axis=[0]), img)
+        mask = tf.where(flip, tf.reverse(mask, axis=[0]), mask)
 
     return img, mask
 
 
+# 默认的原始字节格式, 没有 manifest 的旧数据均按此格式解析
+RAW_SCHEMA = {'format': 'raw', 'image_codec': '', 'compression': ''}
+
+
+# manifest 文件名不能以 base_path 开头, 否则会被 'train.record*' 之类的通配符匹配为数据分片
+def manifest_name(base_path):
+    return os.path.join(os.path.dirname(base_path), 'manifest_' + os.path.basename(base_path) + '.json')
+
+
+# 读取 dataset/img2record.py 写入的 manifest, 不存在时返回空字典
+def read_manifest(file):
+    path = manifest_name(file.rstrip('*'))
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
 # tfrecord格式转换
-def _parse_tfrecord(tfrecord, cfg):
-    x = tf.io.parse_single_example(tfrecord, features={
-        # tf.FixedLenFeature解析的结果为一个tensor
-        'image_raw': tf.io.FixedLenFeature([], tf.string),
-        'label_image': tf.io.FixedLenFeature([], tf.string),
-    })  # 取出包含image和label的feature对象
-
-    # tf.decode_raw可以将字符串解析成图像对应的像素数组
-    image = tf.io.decode_raw(x['image_raw'], tf.uint8)
-    # 根据图像尺寸，还原图像
-    image = tf.reshape(image, [cfg.DATASET.RAW_SIZE[0], cfg.DATASET.RAW_SIZE[1], cfg.DATASET.CHANNELS])
+def _parse_tfrecord(tfrecord, cfg, schema=RAW_SCHEMA):
+    image, label = _decode_tfrecord(tfrecord, cfg, schema)
+    return _convert_sample(image, label, cfg)
+
+
+# tfrecord解码为 RAW_SIZE 的 uint8 图像和掩码
+def _decode_tfrecord(tfrecord, cfg, schema=RAW_SCHEMA):
+    if schema['format'] == 'encoded':
+        x = tf.io.parse_single_example(tfrecord, features={
+            'image_encoded': tf.io.FixedLenFeature([], tf.string),
+            'label_encoded': tf.io.FixedLenFeature([], tf.string),
+        })
+        # PNG/JPEG解码
+        image = tf.io.decode_image(x['image_encoded'], channels=cfg.DATASET.CHANNELS, expand_animations=False)
+        image.set_shape([cfg.DATASET.RAW_SIZE[0], cfg.DATASET.RAW_SIZE[1], cfg.DATASET.CHANNELS])
+        label = tf.io.decode_png(x['label_encoded'], channels=1)
+        label.set_shape([cfg.DATASET.RAW_SIZE[0], cfg.DATASET.RAW_SIZE[1], 1])
+    else:
+        x = tf.io.parse_single_example(tfrecord, features={
+            # tf.FixedLenFeature解析的结果为一个tensor
+            'image_raw': tf.io.FixedLenFeature([], tf.string),
+            'label_image': tf.io.FixedLenFeature([], tf.string),
+        })  # 取出包含image和label的feature对象
+
+        # tf.decode_raw可以将字符串解析成图像对应的像素数组
+        image = tf.io.decode_raw(x['image_raw'], tf.uint8)
+        # 根据图像尺寸，还原图像
+        image = tf.reshape(image, [cfg.DATASET.RAW_SIZE[0], cfg.DATASET.RAW_SIZE[1], cfg.DATASET.CHANNELS])
+        label_image = tf.io.decode_raw(x['label_image'], tf.uint8)
+        label = tf.reshape(label_image, [cfg.DATASET.RAW_SIZE[0], cfg.DATASET.RAW_SIZE[1], 1])
+
+    return image, label
+
+
+# uint8 样本转为 float32 并缩放到 cfg.DATASET.SIZE
+def _convert_sample(image, label, cfg):
     image = tf.image.convert_image_dtype(image, tf.float32)
     image = tf.image.resize(image, cfg.DATASET.SIZE)
-    label_image = tf.io.decode_raw(x['label_image'], tf.uint8)
-    label = tf.reshape(label_image, [cfg.DATASET.RAW_SIZE[0], cfg.DATASET.RAW_SIZE[1], 1])
     # label = tf.cast(label > 128, tf.float32)
     # cla = tf.cast(x['class'], tf.int32)
     # label = tf.image.convert_image_dtype(label, tf.float32)
@@ -61,28 +110,186 @@ def _parse_tfrecord(tfrecord, cfg):
     return image, label
 
 
+# cfg.DATASET.UINT8 时, 增广后的图像量化回 uint8 再进入 batch/prefetch 缓冲区, 由 normalize_image 在训练步内转换
+def _output_sample(image, label, cfg):
+    if cfg.DATASET.UINT8:
+        image = tf.image.convert_image_dtype(image, tf.uint8, saturate=True)
+    return image, label
+
+
+# 验证集从缓存的 uint8 样本转换为输出格式
+def _val_map(image, label, cfg):
+    if cfg.DATASET.UINT8 and tuple(cfg.DATASET.RAW_SIZE) == tuple(cfg.DATASET.SIZE):
+        return image, label
+    return _output_sample(*_convert_sample(image, label, cfg), cfg)
+
+
+# 模型输入的转换和归一化, 作为训练/推理静态图内的第一个操作
+def normalize_image(image, cfg):
+    """
+    uint8 输入先转换到 [0, 1]; cfg.DATASET.NORMALIZE 时再用 datacut2.py 统计的 MEAN/STD 归一化,
+    uint8 和 float32 两种数据管道得到的模型输入相同
+    """
+    if image.dtype != tf.float32:
+        image = tf.cast(image, tf.float32) / 255.
+    if cfg.DATASET.NORMALIZE:
+        image = (image - cfg.DATASET.MEAN) / cfg.DATASET.STD
+    return image
+
+
+# 训练集解析与增广融合为一个map函数, 一次并行调用完成
+def _train_map(sample, cfg, decode):
+    img, mask = decode(*sample)
+    if cfg.AUGMENTATION.COLOR:
+        img, mask = adjust_color(img, mask)
+    if cfg.AUGMENTATION.FLIP:
+        img, mask = random_flip(img, mask, vertical=True)
+    if cfg.AUGMENTATION.SCALE_CROP:
+        img, mask = StepScaleCrop(img, mask, size=cfg.DATASET.SIZE, dl=0.7, ul=1.5, step_size=0.1)
+    # img, mask = random_zoom(img, mask, dl=0.5, ul=1.5)
+    if cfg.AUGMENTATION.GRIDMASK:
+        img, mask = gridmask(img, mask, d1=100, d2=120, rotate=15, ratio=0.1)
+    # img, mask = random_resizedcrop(img, mask, size=cfg.DATASET.SIZE, dl=0.5, ul=1.5)
+    # img, mask = random_erasing(img, mask, probability=0.5, sl=0.02, sh=0.4, r1=0.3)
+    return _output_sample(img, mask, cfg)
+
+
+# 批量增广, 在 dataset.batch() 之后对整个batch执行, 增广种类和参数范围与 _train_map 相同;
+# 颜色增广在转换到HSV调整饱和度之前先截断到 [0, 1], 对比度、亮度调整后越界的像素与逐样本的
+# tf.image.random_saturation 结果略有差别
+def _batch_train_map(imgs, masks, cfg):
+    if cfg.AUGMENTATION.COLOR:
+        imgs, masks = batch_adjust_color(imgs, masks)
+    if cfg.AUGMENTATION.FLIP:
+        imgs, masks = batch_random_flip(imgs, masks, vertical=True)
+    if cfg.AUGMENTATION.SCALE_CROP:
+        imgs, masks = batch_scale_crop(imgs, masks, size=cfg.DATASET.SIZE, dl=0.7, ul=1.5, step_size=0.1)
+    if cfg.AUGMENTATION.GRIDMASK:
+        imgs, masks = batch_gridmask(imgs, masks, d1=100, d2=120, rotate=15, ratio=0.1)
+    return _output_sample(imgs, masks, cfg)
+
+
+# 按前景索引分组的训练集采样
+def _balanced_records(file, manifest, cfg):
+    """
+    dataset/img2record.py 建立前景索引时, 正样本(前景比例大于 fg_th)和负样本写在不同分片中;
+    两组分片各自循环读取、打乱, 再用 sample_from_datasets 以 cfg.DATASET.POS_RATIO 的概率抽取正样本,
+    每个epoch共 cfg.DATASET.NUM_TRAIN 个样本
+    """
+    autotune = tf.data.experimental.AUTOTUNE
+    root = os.path.dirname(file)
+    positive = set(manifest['positive_shards'])
+    datasets = []
+    for is_positive in (True, False):
+        paths = [os.path.join(root, name) for name in manifest['shards'] if (name in positive) == is_positive]
+        files = tf.data.Dataset.from_tensor_slices(paths).shuffle(len(paths), seed=cfg.DATASET.SEED).repeat()
+        records = files.interleave(
+            lambda f: tf.data.TFRecordDataset(f, compression_type=manifest['schema']['compression']),
+            cycle_length=min(cfg.DATASET.CYCLE_LENGTH, len(paths)), num_parallel_calls=autotune)
+        datasets.append(records.shuffle(buffer_size=300))
+    dataset = tf.data.experimental.sample_from_datasets(
+        datasets, weights=[cfg.DATASET.POS_RATIO, 1 - cfg.DATASET.POS_RATIO])
+    return dataset.take(cfg.DATASET.NUM_TRAIN)
+
+
+# 清理已退出进程遗留的验证集缓存文件
+def _remove_stale_cache(cache_dir, prefix):
+    """
+    进程被杀死时缓存文件不完整且 lockfile 不会删除; 文件名中的 pid 对应的进程已不存在时删除这些文件
+    Windows 上 os.kill(pid, 0) 会向进程组发送 CTRL_C_EVENT 而不是检查进程是否存在, 因此不清理, 需手动删除
+    """
+    if os.name == 'nt':
+        return
+    pattern = re.compile(re.escape(prefix) + r'_pid(\d+)[._]')
+    for name in os.listdir(cache_dir):
+        match = pattern.match(name)
+        if match is None:
+            continue
+        try:
+            os.kill(int(match.group(1)), 0)
+        except ProcessLookupError:
+            os.remove(os.path.join(cache_dir, name))
+        except PermissionError:
+            pass
+
+
+# 验证集解码结果缓存
+def _cached_val_records(records, file, manifest, cfg):
+    """
+    缓存解码后的 uint8 样本: 前 cfg.DATASET.VAL_CACHE_MB 的样本保存在内存中, 超出的部分写入 VAL_CACHE_DIR 下的缓存文件,
+    第一遍验证之后不再读取和解析TFRecord; 缓存文件名包含样本尺寸、样本数和进程号, 多个进程(多机训练的各 worker、
+    同时运行的 benchmark.py)各自写自己的缓存文件, 不会争用同一个 lockfile;
+    因此文件缓存只在本次运行内有效, 每次运行的第一遍验证都会重新写入, 上次运行留下的文件在下次运行时删除
+    :param records: 顺序固定的序列化样本
+    """
+    autotune = tf.data.experimental.AUTOTUNE
+    schema = manifest.get('schema', RAW_SCHEMA)
+    h, w = cfg.DATASET.RAW_SIZE
+    num_memory = cfg.DATASET.VAL_CACHE_MB * 2 ** 20 // (h * w * (cfg.DATASET.CHANNELS + 1))
+    num_records = manifest.get('num_records', 0)
+    decode = lambda tfrecord: _decode_tfrecord(tfrecord, cfg, schema)
+
+    memory = records.take(num_memory).map(decode, num_parallel_calls=autotune).cache()
+    spill = records.skip(num_memory).map(decode, num_parallel_calls=autotune)
+    # 只有已知样本数超出内存上限时才建立文件缓存; 没有 manifest 的旧数据超出部分每次重新读取
+    if cfg.DATASET.VAL_CACHE_DIR and num_records > num_memory:
+        if not os.path.isdir(cfg.DATASET.VAL_CACHE_DIR):
+            os.makedirs(cfg.DATASET.VAL_CACHE_DIR)
+        prefix = '{}_{}x{}_{}'.format(os.path.basename(file.rstrip('*')), h, w, num_records)
+        _remove_stale_cache(cfg.DATASET.VAL_CACHE_DIR, prefix)
+        name = '{}_pid{}'.format(prefix, os.getpid())
+        spill = spill.cache(os.path.join(cfg.DATASET.VAL_CACHE_DIR, name))
+    return memory.concatenate(spill)
+
+
 # 数据读取
 def get_dataset(file, cfg, is_training=False):
-    # 获取文件名列表
-    files = tf.data.Dataset.list_files(file)
-    # 读入原始的TFRecord文件, 获得一个 tf.data.Dataset 数据集对象
-    dataset = files.flat_map(tf.data.TFRecordDataset)
-    dataset = dataset.map(lambda x: _parse_tfrecord(x, cfg))
+    autotune = tf.data.experimental.AUTOTUNE
+    if is_training and cfg.DATASET.SOURCE == 'slide':
+        # 直接从切片随机采样, 不经过 PNG/TFRecord, file 参数不使用
+        from utils.slide_dataset import slide_dataset
+        dataset = slide_dataset(cfg)
+        decode = lambda image, label: _convert_sample(image, label, cfg)
+    else:
+        # 根据 manifest 自动识别存储格式和压缩方式
+        manifest = read_manifest(file)
+        schema = manifest.get('schema', RAW_SCHEMA)
+        decode = lambda tfrecord: _parse_tfrecord(tfrecord, cfg, schema)
+        if is_training and cfg.DATASET.POS_RATIO > 0 and manifest.get('positive_shards'):
+            # 按比例分别从正、负样本分片中采样
+            dataset = _balanced_records(file, manifest, cfg)
+        else:
+            # 获取文件名列表; 多机训练按文件切分, 各 worker 使用相同的种子才能得到相同的分片顺序
+            files = tf.data.Dataset.list_files(file, shuffle=is_training, seed=cfg.DATASET.SEED)
+            # 并行读取多个TFRecord分片, 获得一个 tf.data.Dataset 数据集对象; 验证集的缓存需要固定的样本顺序
+            dataset = files.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=schema['compression']),
+                                       cycle_length=cfg.DATASET.CYCLE_LENGTH, num_parallel_calls=autotune,
+                                       deterministic=None if is_training else True)
+            if is_training:
+                # 在解码前打乱序列化后的样本, 缓冲区只保存压缩/原始字节
+                dataset = dataset.shuffle(buffer_size=300)
 
     if is_training:
-        dataset = dataset.shuffle(buffer_size=300)
-        dataset = dataset.map(adjust_color)
-        dataset = dataset.map(lambda x, y: random_flip(x, y, vertical=True))
-        dataset = dataset.map(lambda x, y: StepScaleCrop(x, y, size=cfg.DATASET.SIZE, dl=0.7, ul=1.5, step_size=0.1))
-        # dataset = dataset.map(lambda x, y: random_zoom(x, y, dl=0.5, ul=1.5))
-        # dataset = dataset.map(lambda x, y: gridmask(x, y, d1=100, d2=120, rotate=15, ratio=0.1))
-        # dataset = dataset.map(lambda x, y: random_resizedcrop(x, y, size=cfg.DATASET.SIZE, dl=0.5, ul=1.5))
-        # dataset = dataset.map(lambda x, y: random_erasing(x, y, probability=0.5, sl=0.02, sh=0.4, r1=0.3))
-        dataset = dataset.batch(cfg.TRAIN.BATCH_SIZE)
-        # dataset = dataset.map(lambda x, y: cutmix(x, y, cfg.TRAIN.BATCH_SIZE))
+        if cfg.AUGMENTATION.BATCHED:
+            dataset = dataset.map(decode, num_parallel_calls=autotune)
+            dataset = dataset.batch(cfg.TRAIN.BATCH_SIZE)
+            dataset = dataset.map(lambda x, y: _batch_train_map(x, y, cfg), num_parallel_calls=autotune)
+        else:
+            dataset = dataset.map(lambda *x: _train_map(x, cfg, decode), num_parallel_calls=autotune)
+            dataset = dataset.batch(cfg.TRAIN.BATCH_SIZE)
+        if cfg.AUGMENTATION.CUTMIX:
+            dataset = dataset.map(lambda x, y: cutmix(x, y), num_parallel_calls=autotune)
         # dataset = dataset.map(lambda x, y: random_cutout(x, y, mask_size=40))
     else:
-        dataset = dataset.batch(1)
-    dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        dataset = _cached_val_records(dataset, file, manifest, cfg)
+        dataset = dataset.map(lambda x, y: _val_map(x, y, cfg), num_parallel_calls=autotune)
+        dataset = dataset.batch(cfg.DATASET.VAL_BATCH_SIZE)
+    dataset = dataset.prefetch(buffer_size=autotune)
+
+    # 并行读取和map时是否保持样本顺序, 关闭后吞吐量更高但每次运行的样本顺序不同
+    options = tf.data.Options()
+    options.experimental_deterministic = cfg.DATASET.DETERMINISTIC
+    dataset = dataset.with_options(options)
 
     return dataset
+
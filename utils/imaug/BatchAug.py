@@ -0,0 +1,58 @@
+import tensorflow as tf
+from utils.imaug.Resize import scale_crop_boxes
+
+
+# 以下增广均作用于 dataset.batch() 之后的 [B, H, W, C] 张量, 每个样本的随机参数独立采样,
+# 每种增广对整个batch只执行一次向量化运算
+
+
+# 颜色增广: 对比度、亮度、饱和度
+@tf.function
+def batch_adjust_color(imgs, masks, contrast=0.2, brightness=0.2, saturation=0.2):
+    batch_size = tf.shape(imgs)[0]
+    # 调整对比度
+    factor = tf.random.uniform([batch_size, 1, 1, 1], 1 - contrast, 1 + contrast)
+    mean = tf.reduce_mean(imgs, axis=[1, 2], keepdims=True)
+    imgs = (imgs - mean) * factor + mean
+    # 增加亮度
+    imgs = imgs + tf.random.uniform([batch_size, 1, 1, 1], -brightness, brightness)
+    # 调整饱和度
+    hsv = tf.image.rgb_to_hsv(tf.clip_by_value(imgs, 0, 1))
+    factor = tf.random.uniform([batch_size, 1, 1], 1 - saturation, 1 + saturation)
+    hsv = tf.stack([hsv[..., 0], tf.clip_by_value(hsv[..., 1] * factor, 0, 1), hsv[..., 2]], axis=-1)
+    imgs = tf.image.hsv_to_rgb(hsv)
+    # 将img限制在 [0, 1]
+    imgs = tf.clip_by_value(imgs, 0, 1)
+
+    return imgs, masks
+
+
+# 随机翻转
+@tf.function
+def batch_random_flip(imgs, masks, vertical=False):
+    batch_size = tf.shape(imgs)[0]
+    flip = tf.random.uniform([batch_size, 1, 1, 1]) < 0.5
+    imgs = tf.where(flip, tf.reverse(imgs, axis=[2]), imgs)
+    masks = tf.where(flip, tf.reverse(masks, axis=[2]), masks)
+    if vertical is True:
+        flip = tf.random.uniform([batch_size, 1, 1, 1]) < 0.5
+        imgs = tf.where(flip, tf.reverse(imgs, axis=[1]), imgs)
+        masks = tf.where(flip, tf.reverse(masks, axis=[1]), masks)
+
+    return imgs, masks
+
+
+# 随机按一定步长缩放, 随机裁剪
+@tf.function
+def batch_scale_crop(imgs, masks, size, dl=0.25, ul=2., step_size=0.1):
+    batch_size = tf.shape(imgs)[0]
+    boxes = scale_crop_boxes(batch_size, dl, ul, step_size)
+    box_indices = tf.range(batch_size)
+    imgs = tf.image.crop_and_resize(imgs, boxes, box_indices, size, method='bilinear', extrapolation_value=0)
+    # 填充区域的标签为255, 计算损失时忽略
+    masks_dtype = masks.dtype
+    masks = tf.image.crop_and_resize(tf.cast(masks, tf.float32), boxes, box_indices, size,
+                                     method='nearest', extrapolation_value=255)
+    masks = tf.cast(masks, masks_dtype)
+
+    return imgs, masks
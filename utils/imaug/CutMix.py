@@ -3,48 +3,38 @@ import tensorflow as tf
 
 # CutMix, 在train里使用
 @tf.function
-def cutmix(img_batch, mask_batch, batch_size):
+def cutmix(img_batch, mask_batch, batch_size=None):
     """
+    用广播生成每个样本的裁剪框掩码, 一次 tf.where 完成整个batch的拼接;
+    batch大小取自输入的动态形状, 最后一个不满的batch也不会重新追踪
 
-    :param img_batch:
-    :param mask_batch:
-    :param batch_size:
+    :param img_batch: [B, H, W, C]
+    :param mask_batch: [B, H, W, 1]
+    :param batch_size: 保留参数, 不再使用
     :return:
     """
-    img_h, img_w, img_channels = tf.shape(img_batch)[1], tf.shape(img_batch)[2], tf.shape(img_batch)[3]
-    imgs, masks = [], []
+    batch_size = tf.shape(img_batch)[0]
+    img_h, img_w = tf.shape(img_batch)[1], tf.shape(img_batch)[2]
     # CHOOSE RANDOM LOCATION
     cut_xs = tf.cast(tf.random.uniform([batch_size], 0, tf.cast(img_w, tf.float32)), tf.int32)
     cut_ys = tf.cast(tf.random.uniform([batch_size], 0, tf.cast(img_h, tf.float32)), tf.int32)
     cut_ratios = tf.math.sqrt(1 - tf.random.uniform([batch_size], 0, 1))  # cut ratio
     cut_ws = tf.cast(tf.cast(img_w, tf.float32) * cut_ratios, tf.int32)
     cut_hs = tf.cast(tf.cast(img_h, tf.float32) * cut_ratios, tf.int32)
-    yas = tf.math.maximum(0, cut_ys - cut_hs // 2)
-    ybs = tf.math.minimum(img_h, cut_ys + cut_hs // 2)
-    xas = tf.math.maximum(0, cut_xs - cut_ws // 2)
-    xbs = tf.math.minimum(img_w, cut_xs + cut_ws // 2)
+    yas = tf.math.maximum(0, cut_ys - cut_hs // 2)[:, None, None, None]
+    ybs = tf.math.minimum(img_h, cut_ys + cut_hs // 2)[:, None, None, None]
+    xas = tf.math.maximum(0, cut_xs - cut_ws // 2)[:, None, None, None]
+    xbs = tf.math.minimum(img_w, cut_xs + cut_ws // 2)[:, None, None, None]
     # CHOOSE RANDOM IMAGE TO CUTMIX WITH
     js = tf.random.shuffle(tf.range(batch_size, dtype=tf.int32))
-    for i in range(batch_size):
-        ya, yb, xa, xb, j = yas[i], ybs[i], xas[i], xbs[i], js[i]
-        img_org, img_cut, mask_org, mask_cut = img_batch[i], img_batch[j], mask_batch[i], mask_batch[j]
-        # MAKE CUTMIX IMAGE
-        img_org_left_middle = img_org[ya:yb, 0:xa, :]
-        img_cut = img_cut[ya:yb, xa:xb, :]
-        img_org_right_middle = img_org[ya:yb, xb:img_w, :]
-        img_middle = tf.concat([img_org_left_middle, img_cut, img_org_right_middle], axis=1)
-        img_cutmix = tf.concat([img_org[0:ya, :, :], img_middle, img_org[yb:img_h, :, :]], axis=0)
-        imgs.append(img_cutmix)
 
-        # MAKE CUTMIX MASK
-        mask_org_left_middle = mask_org[ya:yb, 0:xa, :]
-        mask_cut = mask_cut[ya:yb, xa:xb, :]
-        mask_org_right_middle = mask_org[ya:yb, xb:img_w, :]
-        mask_middle = tf.concat([mask_org_left_middle, mask_cut, mask_org_right_middle], axis=1)
-        mask_cutmix = tf.concat([mask_org[0:ya, :, :], mask_middle, mask_org[yb:img_h, :, :]], axis=0)
-        masks.append(mask_cutmix)
+    # [B, H, W, 1] 的裁剪框掩码
+    ys = tf.range(img_h)[None, :, None, None]
+    xs = tf.range(img_w)[None, None, :, None]
+    box = (ys >= yas) & (ys < ybs) & (xs >= xas) & (xs < xbs)
 
-    img_batch = tf.reshape(tf.stack(imgs), (batch_size, img_h, img_w, 3))
-    label_batch = tf.reshape(tf.stack(masks), (batch_size, img_h, img_w, 1))
+    # MAKE CUTMIX IMAGE AND MASK
+    img_batch = tf.where(box, tf.gather(img_batch, js), img_batch)
+    label_batch = tf.where(box, tf.gather(mask_batch, js), mask_batch)
 
     return img_batch, label_batch
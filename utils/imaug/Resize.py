@@ -44,46 +44,58 @@ def get_random_scale(min_scale_factor, max_scale_factor, step_size):
         随机尺度值
 
     """
+    table = scale_table(min_scale_factor, max_scale_factor, step_size)
+    if table is None:
+        return tf.random.uniform([], min_scale_factor, max_scale_factor)
+    # 从预先计算好的比例表中随机取一个, 不再每次调用 np.linspace 和 tf.random.shuffle
+    return tf.gather(table, tf.random.uniform([], 0, len(table), dtype=tf.int32))
 
-    if min_scale_factor < 0 or min_scale_factor > max_scale_factor:
-        raise ValueError('Unexpected value of min_scale_factor.')
-
-    if min_scale_factor == max_scale_factor:
-        return min_scale_factor
 
+# 候选缩放比例表
+def scale_table(dl, ul, step_size):
+    """
+    与 get_random_scale 的取值范围一致: step_size 为0时返回 None, 表示在 [dl, ul] 内连续采样
+    """
+    if dl < 0 or dl > ul:
+        raise ValueError('Unexpected value of min_scale_factor.')
+    if dl == ul:
+        return np.array([dl], np.float32)
     if step_size == 0:
-        return tf.random.uniform([], min_scale_factor, max_scale_factor)
+        return None
+    num_steps = int((ul - dl) / step_size + 1)
+    return np.linspace(dl, ul, num_steps).astype(np.float32)
 
-    num_steps = int((max_scale_factor - min_scale_factor) / step_size + 1)
-    scale_factors = np.linspace(min_scale_factor, max_scale_factor,
-                                num_steps).tolist()
-    scale_factors = tf.random.shuffle(scale_factors)
-    return scale_factors[0]
+
+# 每个样本的缩放裁剪框
+def scale_crop_boxes(batch_size, dl=0.25, ul=2., step_size=0.1):
+    """
+    缩放 scale 倍后随机裁剪原尺寸, 等价于在原图上取边长为 1/scale 的归一化窗口再缩放回原尺寸;
+    scale < 1 时窗口超出原图, 超出部分由 crop_and_resize 的 extrapolation_value 填充
+    :return: [batch_size, 4] 归一化的 (y1, x1, y2, x2)
+    """
+    table = scale_table(dl, ul, step_size)
+    if table is None:
+        scale = tf.random.uniform([batch_size], dl, ul)
+    else:
+        scale = tf.gather(table, tf.random.uniform([batch_size], 0, len(table), dtype=tf.int32))
+    size = 1. / scale
+    offset = tf.random.uniform([batch_size, 2]) * (1. - size)[:, None]
+    return tf.concat([offset, offset + size[:, None]], axis=1)
 
 
 # 随机按一定步长缩放, 随机裁剪
+@tf.function
 def StepScaleCrop(img, mask, size, dl=0.25, ul=2., step_size=0.1):
-    scale = get_random_scale(dl, ul, step_size)
-    img_h, img_w = size[0], size[1]
-    img_h_new, img_w_new = int(img_h * scale), int(img_w * scale)
-    img_new = tf.image.resize(img, [img_h_new, img_w_new], method=tf.image.ResizeMethod.BILINEAR)
-    mask_new = tf.image.resize(mask, [img_h_new, img_w_new], method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
-    pad_h, pad_w = 0, 0
-    if img_h_new == size[0] and img_w_new == size[1]:
-        return img_new, mask_new
-    if img_h_new < size[0]:
-        pad_h = (size[0] - img_h_new) // 2 + 1
-    if img_w_new < size[1]:
-        pad_w = (size[1] - img_w_new) // 2 + 1
-    if pad_h > 0 or pad_w > 0:
-        img_new = tf.pad(img_new, [[pad_h, pad_h], [pad_w, pad_w], [0, 0]])
-        mask_new = tf.pad(mask_new, [[pad_h, pad_h], [pad_w, pad_w], [0, 0]], 'CONSTANT', constant_values=255)
-    im_h, im_w = tf.cast(tf.shape(img_new)[0], tf.float32), tf.cast(tf.shape(img_new)[1], tf.float32)
-    sh, sw = tf.random.uniform([], 0, 1), tf.random.uniform([], 0, 1)
-    sh, sw = tf.cast(sh * (im_h - size[0]), tf.int32), tf.cast(sw * (im_w - size[1]), tf.int32)
-
-    img_new = img_new[sh:sh + size[0], sw:sw + size[1], :]
-    mask_new = mask_new[sh:sh + size[0], sw:sw + size[1]]
+    """
+    缩放和裁剪合并为一次 crop_and_resize, 输出形状恒为 size, 不会因随机比例不同而重新追踪
+    填充区域的标签为255, 计算损失时忽略
+    """
+    boxes = scale_crop_boxes(1, dl, ul, step_size)
+    img_new = tf.image.crop_and_resize(img[None], boxes, [0], size, method='bilinear', extrapolation_value=0)
+    mask_new = tf.image.crop_and_resize(tf.cast(mask[None], tf.float32), boxes, [0], size,
+                                        method='nearest', extrapolation_value=255)
+    img_new = tf.reshape(img_new, [size[0], size[1], img.shape[-1]])
+    mask_new = tf.reshape(tf.cast(mask_new, mask.dtype), [size[0], size[1], mask.shape[-1]])
 
     return img_new, mask_new
 
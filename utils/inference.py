@@ -0,0 +1,221 @@
+import os
+import numpy as np
+import cv2
+
+
+# 分配输出数组, 指定目录时使用磁盘映射
+def alloc_array(shape, dtype, memmap_dir=None, name='array'):
+    """
+    :param shape: 数组尺寸
+    :param dtype: 数据类型
+    :param memmap_dir: 为空时在内存中分配, 否则在该目录下创建 np.memmap 文件
+    :param name: memmap 文件名
+    :return: 全零数组
+    """
+    if not memmap_dir:
+        return np.zeros(shape, dtype)
+    if not os.path.isdir(memmap_dir):
+        os.makedirs(memmap_dir)
+    # 新建的memmap文件内容全为0
+    return np.memmap(os.path.join(memmap_dir, name + '.dat'), dtype=dtype, mode='w+', shape=shape)
+
+
+# 删除 alloc_array 创建的 memmap 文件
+def remove_array(memmap_dir, name='array'):
+    """
+    调用前需先释放对该数组(包括切片视图)的引用
+    """
+    if memmap_dir and os.path.isfile(os.path.join(memmap_dir, name + '.dat')):
+        os.remove(os.path.join(memmap_dir, name + '.dat'))
+
+
+# 分块最近邻缩放
+def resize_nearest(src, dsize, out=None, band=2048):
+    """
+    按行分块做最近邻缩放, 输出可以是 np.memmap, 峰值内存只与 band 行有关
+    采样位置与 cv2.INTER_NEAREST 一致: src_idx = floor(dst_idx * src_len / dst_len)
+    :param src: [h, w, ...] 输入
+    :param dsize: 输出尺寸 (W, H)
+    :param out: 预分配的输出数组, 为空时在内存中分配
+    :param band: 每次处理的输出行数
+    :return: [H, W, ...] 输出
+    """
+    dst_w, dst_h = dsize
+    if out is None:
+        out = np.zeros((dst_h, dst_w) + src.shape[2:], src.dtype)
+    rows = (np.arange(dst_h, dtype=np.int64) * src.shape[0] // dst_h)
+    cols = (np.arange(dst_w, dtype=np.int64) * src.shape[1] // dst_w)
+    for r0 in range(0, dst_h, band):
+        out[r0:r0 + band] = src[rows[r0:r0 + band]][:, cols]
+    return out
+
+
+# 进程峰值内存 (MB)
+def peak_rss_mb():
+    import resource
+    import sys
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 返回字节, linux 返回KB
+    return rss / 1024. / 1024. if sys.platform == 'darwin' else rss / 1024.
+
+
+# 滑动窗口左上角坐标
+def tile_coords(h, w, stride, target_size):
+    """
+    按行优先顺序生成滑动窗口左上角坐标, 同一行的裁剪块连续读取, 条带存储的TIFF每个条带只需解码一次(见 SlideReader)
+    :param h: 填充后图像高
+    :param w: 填充后图像宽
+    :param stride: 滑动步长
+    :param target_size: 裁剪尺寸 (w, h)
+    :return: [(topleft_x, topleft_y), ...]
+    """
+    coords = []
+    for j in range(h // stride - 1):
+        for i in range(w // stride - 1):
+            coords.append((i * stride, j * stride))
+    return coords
+
+
+# 低分辨率组织区域预筛选
+def tissue_tiles(image, coords, target_size, reduce=16, s_th=40, p_th=400, small=None):
+    """
+    在缩小 reduce 倍的图像上按饱和度计算组织掩码, 判断每个裁剪块是否需要送入模型
+    阈值含义与 dataset/datacut2.py 一致: 饱和度大于 s_th 的像素数不超过 p_th 的块视为空白玻片或黑色填充
+    :param image: 已填充的整张图像 [H, W, 3]
+    :param coords: tile_coords 返回的坐标列表
+    :param target_size: 裁剪尺寸 (w, h)
+    :param reduce: 预筛选时的缩小倍数
+    :param s_th: 饱和度阈值
+    :param p_th: 原分辨率下的最少组织像素数
+    :param small: 已缩小 reduce 倍的图像, 不为空时 image 可以为 None (如 ScaledPaddedView.thumbnail 的结果)
+    :return: (需要推理的坐标, 跳过的坐标)
+    """
+    target_w, target_h = target_size
+    if small is None:
+        small = cv2.resize(image, (image.shape[1] // reduce, image.shape[0] // reduce),
+                           interpolation=cv2.INTER_AREA)
+    # 饱和度与通道顺序无关, RGB/BGR均可
+    tissue = (cv2.cvtColor(small, cv2.COLOR_RGB2HSV)[..., 1] > s_th).astype(np.int64)
+    # 积分图, 每个裁剪块的组织像素数O(1)求得
+    integral = np.pad(tissue.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+
+    keep, skip = [], []
+    for x, y in coords:
+        x0, y0 = x // reduce, y // reduce
+        x1, y1 = (x + target_w) // reduce, (y + target_h) // reduce
+        count = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+        if count * reduce * reduce > p_th:
+            keep.append((x, y))
+        else:
+            skip.append((x, y))
+    return keep, skip
+
+
+class TileEngine(object):
+    """
+    批量滑窗推理引擎: 将裁剪坐标收集为batch, 每个batch只调用一次模型, 再把结果按坐标返回给调用方写回
+
+    最后一个不满的batch会补零到 batch_size, 保证 tf.function 只按一个输入形状追踪一次
+    """
+
+    def __init__(self, predict_fn, target_size, batch_size=8, channels=3, dtype=np.float32):
+        """
+        :param predict_fn: 输入 [B, H, W, C] dtype 数组, 返回 [B, H, W, ...] 的预测结果
+        :param target_size: 裁剪尺寸 (w, h)
+        :param batch_size: 每次送入模型的裁剪块数量
+        :param channels: 图像通道数
+        :param dtype: 输入缓冲区类型, uint8 时传给模型的数据量只有 float32 的1/4
+        """
+        self.predict_fn = predict_fn
+        self.target_w, self.target_h = target_size
+        self.batch_size = batch_size
+        # 输入缓冲区只分配一次, 所有batch复用
+        self.buffer = np.zeros((batch_size, self.target_h, self.target_w, channels), dtype)
+
+    def run(self, image, coords):
+        """
+        :param image: 已填充的整张图像 [H, W, C]
+        :param coords: tile_coords 返回的坐标列表
+        :return: 生成器, 逐块产出 ((topleft_x, topleft_y), out)
+        """
+        for start in range(0, len(coords), self.batch_size):
+            chunk = coords[start:start + self.batch_size]
+            n = len(chunk)
+            for k, (x, y) in enumerate(chunk):
+                self.buffer[k] = image[y:y + self.target_h, x:x + self.target_w]
+            if n < self.batch_size:
+                self.buffer[n:] = 0
+            out = np.asarray(self.predict_fn(self.buffer))
+            for k in range(n):
+                yield chunk[k], out[k]
+
+
+# 高斯权重窗口
+def gaussian_window(target_size, sigma_scale=0.125, min_weight=1e-3):
+    """
+    中心权重为1, 向边缘按高斯衰减, 用于重叠滑窗时抑制裁剪块边缘预测的影响
+    :param target_size: 裁剪尺寸 (w, h)
+    :param sigma_scale: 标准差与裁剪尺寸之比
+    :param min_weight: 权重下限, 避免float16下溢导致图像边缘处权重为0
+    :return: [h, w] float16
+    """
+    target_w, target_h = target_size
+    ys = np.arange(target_h, dtype=np.float32) - (target_h - 1) / 2.
+    xs = np.arange(target_w, dtype=np.float32) - (target_w - 1) / 2.
+    gy = np.exp(-ys ** 2 / (2 * (target_h * sigma_scale) ** 2))
+    gx = np.exp(-xs ** 2 / (2 * (target_w * sigma_scale) ** 2))
+    window = np.outer(gy, gx)
+    return np.maximum(window / window.max(), min_weight).astype(np.float16)
+
+
+class ProbAccumulator(object):
+    """
+    重叠滑窗概率融合: 每个裁剪块的前景概率乘以权重窗口后累加, 结束时统一除以权重和再阈值化
+
+    累加器每张切片只分配一次, 逐块累加时复用临时缓冲区, 不产生新的数组
+    """
+
+    def __init__(self, shape, window, dtype=np.float16, memmap_dir=None):
+        """
+        :param shape: 填充后图像尺寸 (H, W)
+        :param window: gaussian_window 返回的权重窗口
+        :param dtype: 累加器数据类型
+        :param memmap_dir: 不为空时概率和权重累加器保存在该目录下的 np.memmap 中
+        """
+        self.window = window.astype(dtype)
+        self.prob = alloc_array(shape, dtype, memmap_dir, 'prob')
+        self.weight = alloc_array(shape, dtype, memmap_dir, 'weight')
+        self.tmp = np.zeros(window.shape, dtype)
+        self.memmap_dir = memmap_dir
+
+    def add(self, x, y, prob):
+        th, tw = self.window.shape
+        np.multiply(prob, self.window, out=self.tmp)
+        prob_view = self.prob[y:y + th, x:x + tw]
+        np.add(prob_view, self.tmp, out=prob_view)
+        weight_view = self.weight[y:y + th, x:x + tw]
+        np.add(weight_view, self.window, out=weight_view)
+
+    def result(self, threshold=0.5, out=None, band=2048):
+        """
+        按行分块除以权重和并阈值化, 避免产生与整张切片同尺寸的临时数组
+        :param threshold: 融合后前景概率的阈值
+        :param out: 预分配的 [H, W] uint8 输出, 为空时在内存中分配
+        :param band: 每次处理的行数
+        :return: [H, W] uint8 掩码
+        """
+        if out is None:
+            out = np.zeros(self.prob.shape, np.uint8)
+        for r0 in range(0, self.prob.shape[0], band):
+            prob, weight = self.prob[r0:r0 + band], self.weight[r0:r0 + band]
+            np.divide(prob, weight, out=prob, where=weight > 0)
+            out[r0:r0 + band] = prob > threshold
+        return out
+
+    def close(self):
+        """
+        释放累加器, memmap 模式下删除 prob.dat 和 weight.dat
+        """
+        self.prob, self.weight = None, None
+        remove_array(self.memmap_dir, 'prob')
+        remove_array(self.memmap_dir, 'weight')
@@ -390,4 +390,8 @@ def get_loss(cfg, loss_type):
     else:
         raise TypeError('Unsupported loss type')
 
-    return loss
+    # 混合精度时模型输出可能是 float16/bfloat16, 损失统一在 float32 下计算
+    def float32_loss(y_true, y_pred):
+        return loss(y_true, tf.cast(y_pred, tf.float32))
+
+    return float32_loss
@@ -0,0 +1,155 @@
+import numpy as np
+
+
+# 行程数组格式化为字符串
+def runs2str(starts, lengths):
+    """
+    :param starts: 1起始的行程起点
+    :param lengths: 行程长度
+    :return: 'start length start length ...'
+    """
+    runs = np.empty(len(starts) * 2, np.int64)
+    runs[0::2], runs[1::2] = starts, lengths
+    return ' '.join(runs.astype(str))
+
+
+# 流式rle编码
+def rle_runs(mask, full_shape=None, band=1024):
+    """
+    按列分块对掩码做列优先(与 mask.T.flatten() 相同)的rle编码, 逐块产出行程, 不生成完整的一维像素数组
+    给定 full_shape 时, 直接编码 mask 按最近邻放大到 full_shape 之后的结果, 无需生成原分辨率掩码,
+    采样位置与 utils.inference.resize_nearest 一致
+    :param mask: [h, w] 0/1 掩码, 可以是 np.memmap
+    :param full_shape: 原分辨率尺寸 (H, W), 为空时等于 mask 尺寸
+    :param band: 每次处理的原分辨率列数
+    :return: 生成器, 逐块产出 (starts, lengths), starts 为1起始
+    """
+    h, w = mask.shape[:2]
+    full_h, full_w = full_shape if full_shape is not None else (h, w)
+    cols = np.arange(full_w, dtype=np.int64) * w // full_w
+    # 低分辨率第 r 行对应原分辨率的起始行: ceil(r * H / h)
+    row_start = (np.arange(h + 1, dtype=np.int64) * full_h + h - 1) // h
+
+    pending = None  # 上一块的最后一个行程, 可能与下一块第一个行程首尾相接
+    for c0 in range(0, full_w, band):
+        block = np.zeros((min(band, full_w - c0), h + 2), np.int8)
+        block[:, 1:-1] = np.asarray(mask[:, cols[c0:c0 + band]]).T > 0
+        diff = np.diff(block, axis=1)
+        s_col, s_row = np.nonzero(diff == 1)
+        _, e_row = np.nonzero(diff == -1)
+
+        offset = (c0 + s_col) * full_h + 1
+        starts = offset + row_start[s_row]
+        ends = offset + row_start[e_row]
+        keep = ends > starts
+        starts, ends = starts[keep], ends[keep]
+        if pending is not None:
+            starts, ends = np.r_[pending[0], starts], np.r_[pending[1], ends]
+        if len(starts) == 0:
+            continue
+
+        # 列尾与下一列列首相接的行程合并为一个
+        join = starts[1:] == ends[:-1]
+        starts, ends = starts[np.r_[True, ~join]], ends[np.r_[~join, True]]
+        pending = starts[-1:], ends[-1:]
+        yield starts[:-1], ends[:-1] - starts[:-1]
+
+    if pending is not None:
+        yield pending[0], pending[1] - pending[0]
+
+
+# 图像转rle编码
+def mask2rle(mask, full_shape=None, band=1024):
+    """
+    流式版本的 mask2rle, 结果与 ' '.join(str(x) for x in runs) 的原实现一致
+    :param mask: [h, w] 0/1 掩码
+    :param full_shape: 原分辨率尺寸 (H, W), 见 rle_runs
+    :param band: 每次处理的原分辨率列数
+    :return: rle字符串
+    """
+    parts = [runs2str(starts, lengths) for starts, lengths in rle_runs(mask, full_shape, band)]
+    return ' '.join(p for p in parts if p)
+
+
+# 解析rle字符串
+def rle2runs(enc):
+    """
+    :param enc: 'start length start length ...', start 为1起始
+    :return: (starts, ends), 0起始, 左闭右开
+    """
+    runs = np.fromstring(enc, dtype=np.int64, sep=' ')
+    starts = runs[0::2] - 1
+    return starts, starts + runs[1::2]
+
+
+# RLE编码转图像
+def enc2mask(encs, shape, reduce=1, pad=((0, 0), (0, 0)), band=512):
+    """
+    向量化的rle解码, 第 m 个编码对应的像素值为 1 + m
+    reduce > 1 或 pad 不为0时, 结果等价于先对原分辨率掩码 np.pad 再 cv2.resize(INTER_NEAREST) 缩小 reduce 倍,
+    但只在采样点上查找行程, 不生成原分辨率掩码
+    :param encs: rle字符串列表, nan 表示空
+    :param shape: 原分辨率尺寸 (W, H)
+    :param reduce: 整数缩小倍数
+    :param pad: [[上, 下], [左, 右]] 填充宽度
+    :param band: 采样时每次处理的列数
+    :return: [(H + 上 + 下) // reduce, (W + 左 + 右) // reduce] uint8
+    """
+    w, h = shape
+    (top, bottom), (left, right) = pad
+    if reduce == 1 and top == bottom == left == right == 0:
+        img = np.zeros(w * h, dtype=np.uint8)
+        for m, enc in enumerate(encs):
+            if isinstance(enc, float) and np.isnan(enc): continue
+            starts, ends = rle2runs(enc)
+            # 行程起点+1, 终点-1, 累加后非零处即为前景; 同一编码内的起点、终点各自互不重复
+            delta = np.zeros(w * h + 1, dtype=np.int8)
+            delta[starts] += 1
+            delta[ends] -= 1
+            img[np.cumsum(delta[:-1], dtype=np.int8) > 0] = 1 + m
+        return img.reshape(shape).T
+
+    rows = np.arange((h + top + bottom) // reduce, dtype=np.int64) * reduce - top
+    cols = np.arange((w + left + right) // reduce, dtype=np.int64) * reduce - left
+    return _sample_runs(encs, (w, h), rows, cols, band)
+
+
+# 解码原分辨率掩码的一个水平条带
+def enc2band(encs, shape, y0, y1, band=512):
+    """
+    只解码原分辨率掩码的 [y0, y1) 行, 超出切片的行填0; 结果与 enc2mask(encs, shape)[y0:y1] (越界部分补0) 相同,
+    内存只与条带大小有关
+    :param encs: rle字符串列表, nan 表示空
+    :param shape: 原分辨率尺寸 (W, H)
+    :param y0: 起始行, 可以为负
+    :param y1: 结束行, 可以超过 H
+    :param band: 采样时每次处理的列数
+    :return: [y1 - y0, W] uint8
+    """
+    return _sample_runs(encs, shape, np.arange(y0, y1, dtype=np.int64), np.arange(shape[0], dtype=np.int64), band)
+
+
+# 在采样点上查找行程
+def _sample_runs(encs, shape, rows, cols, band):
+    """
+    :param shape: 原分辨率尺寸 (W, H)
+    :param rows: 原分辨率上的采样行, 越界的行为0
+    :param cols: 原分辨率上的采样列, 越界的列为0
+    :return: [len(rows), len(cols)] uint8, 第 m 个编码对应的像素值为 1 + m
+    """
+    w, h = shape
+    img = np.zeros((len(rows), len(cols)), dtype=np.uint8)
+    valid_rows = (rows >= 0) & (rows < h)
+    for m, enc in enumerate(encs):
+        if isinstance(enc, float) and np.isnan(enc): continue
+        starts, ends = rle2runs(enc)
+        if len(starts) == 0: continue
+        for c0 in range(0, len(cols), band):
+            c = cols[c0:c0 + band]
+            # 列优先展开后的像素下标
+            q = c[:, None] * h + rows[None, :]
+            k = np.searchsorted(starts, q, side='right') - 1
+            inside = (k >= 0) & (q < ends[np.maximum(k, 0)])
+            inside &= ((c >= 0) & (c < w))[:, None] & valid_rows[None, :]
+            img[:, c0:c0 + band][inside.T] = 1 + m
+    return img
@@ -17,6 +17,48 @@ def fast_hist(a, b, n):
     return np.bincount(n * a[k].astype(int) + b[k], minlength=n ** 2).reshape(n, n)
 
 
+# 图内计算的混淆矩阵, 与 fast_hist 相同: 横看真实, 竖看预测, 超出 [0, n) 的标签(如255)被忽略
+def confusion_matrix(label, predict, n):
+    """
+    :param label: 任意形状的标注图
+    :param predict: 与 label 元素个数相同的预测图
+    :param n: 类别数
+    :return: [n, n] int64
+    """
+    # tf.math.bincount 只接受 int32 的输入, n * n 很小, 下标不会溢出; 计数仍为 int64
+    label = tf.cast(tf.reshape(label, [-1]), tf.int32)
+    predict = tf.cast(tf.reshape(predict, [-1]), tf.int32)
+    k = (label >= 0) & (label < n)
+    index = n * tf.boolean_mask(label, k) + tf.boolean_mask(predict, k)
+    count = tf.math.bincount(index, minlength=n ** 2, maxlength=n ** 2, dtype=tf.int64)
+    return tf.reshape(count, [n, n])
+
+
+# 图内根据混淆矩阵计算评价指标, 与 SegmentationMetric 一致, 分母为0的类别不参与平均
+def segmentation_metrics(confusion):
+    """
+    :param confusion: [n, n] 混淆矩阵, 横看真实, 竖看预测
+    :return: {'PA', 'mPA', 'mIoU', 'dice', 'IoU': [n]}
+    """
+    confusion = tf.cast(confusion, tf.float64)
+    tp = tf.linalg.diag_part(confusion)
+    rows = tf.reduce_sum(confusion, axis=1)
+    cols = tf.reduce_sum(confusion, axis=0)
+
+    def divide(a, b):
+        return tf.where(b > 0, a / tf.where(b > 0, b, tf.ones_like(b)), tf.fill(tf.shape(a), tf.cast(np.nan, a.dtype)))
+
+    def nanmean(x):
+        return tf.reduce_mean(tf.boolean_mask(x, tf.logical_not(tf.math.is_nan(x))))
+
+    iou = divide(tp, rows + cols - tp)
+    return {'PA': divide(tf.reduce_sum(tp), tf.reduce_sum(confusion)),
+            'mPA': nanmean(divide(tp, rows)),
+            'mIoU': nanmean(iou),
+            'dice': nanmean(divide(2. * tp, rows + cols)),
+            'IoU': iou}
+
+
 class SegmentationMetric(object):
     def __init__(self, num_class):
         self.num_class = num_class
@@ -111,6 +153,10 @@ class SegmentationMetric(object):
         assert img_predict.shape == img_label.shape
         self.confusionMatrix += self.genConfusionMatrix(img_predict, img_label)
 
+    # 累加图内计算的混淆矩阵
+    def addConfusionMatrix(self, confusionMatrix):
+        self.confusionMatrix += np.asarray(confusionMatrix)
+
     def reset(self):
         self.confusionMatrix = np.zeros((self.num_class, self.num_class))
 
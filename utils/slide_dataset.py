@@ -0,0 +1,104 @@
+import os
+import numpy as np
+import pandas as pd
+import cv2
+import tensorflow as tf
+from utils.slide import SlideReader
+from utils.rle import enc2mask
+
+
+class SlideTileSampler(object):
+    """
+    直接从切片随机采样训练裁剪块, 跳过 datacut2.py -> img2record.py 的离线裁剪流程
+
+    每张切片只在第一次使用时按 reduce 倍缩小解码一次, 图像和掩码以 .npy 缓存到 cache_dir,
+    之后以 mmap 方式打开, 采样时只读取所需窗口; 修改裁剪尺寸不需要重新生成数据
+    """
+
+    def __init__(self, tiff_dir, csv_path, cache_dir, reduce=2, tile_size=512, out_size=(512, 512),
+                 s_th=40, p_th=None, max_tries=20):
+        """
+        :param tiff_dir: 训练切片目录
+        :param csv_path: train.csv 路径
+        :param cache_dir: 解码后切片的缓存目录
+        :param reduce: 解码时的缩小倍数
+        :param tile_size: 缩小后切片上的裁剪尺寸
+        :param out_size: 输出尺寸 (h, w)
+        :param s_th: saturation blancking threshold
+        :param p_th: threshold for the minimum number of pixels, 为空时与 datacut2.py 一致
+        :param max_tries: 连续采到背景块的最大次数, 超过后直接返回
+        """
+        self.tiff_dir = tiff_dir
+        self.cache_dir = cache_dir
+        self.reduce = reduce
+        self.tile_size = tile_size
+        self.out_size = out_size
+        self.s_th = s_th
+        self.p_th = p_th if p_th is not None else 200 * tile_size // 256
+        self.max_tries = max_tries
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        df_masks = pd.read_csv(csv_path).set_index('id')
+        self.slides = [self._load(index, list(encs)) for index, encs in df_masks.iterrows()]
+        # 按面积加权选择切片
+        areas = np.array([img.shape[0] * img.shape[1] for img, _ in self.slides], np.float64)
+        self.probs = areas / areas.sum()
+
+    def _load(self, index, encs):
+        img_path = os.path.join(self.cache_dir, '{}_r{}_img.npy'.format(index, self.reduce))
+        mask_path = os.path.join(self.cache_dir, '{}_r{}_mask.npy'.format(index, self.reduce))
+        if not (os.path.isfile(img_path) and os.path.isfile(mask_path)):
+            with SlideReader(os.path.join(self.tiff_dir, index + '.tiff'), cache_rows=0) as slide:
+                h, w = slide.shape[0], slide.shape[1]
+                np.save(img_path, slide.read(0, 0, w, h, reduce=self.reduce))
+            np.save(mask_path, enc2mask(encs, (w, h), reduce=self.reduce))
+        return np.load(img_path, mmap_mode='r'), np.load(mask_path, mmap_mode='r')
+
+    def sample(self, rng):
+        """
+        :param rng: np.random.RandomState
+        :return: ([h, w, 3] uint8, [h, w, 1] uint8)
+        """
+        for _ in range(self.max_tries):
+            img, mask = self.slides[rng.choice(len(self.slides), p=self.probs)]
+            th, tw = min(self.tile_size, img.shape[0]), min(self.tile_size, img.shape[1])
+            y = rng.randint(0, img.shape[0] - th + 1)
+            x = rng.randint(0, img.shape[1] - tw + 1)
+            crop_image = np.array(img[y:y + th, x:x + tw])
+            # remove black or gray images based on saturation check
+            s = cv2.cvtColor(crop_image, cv2.COLOR_RGB2HSV)[..., 1]
+            if (s > self.s_th).sum() > self.p_th and crop_image.sum() > self.p_th:
+                break
+        crop_label = np.array(mask[y:y + th, x:x + tw])
+        crop_image = cv2.resize(crop_image, (self.out_size[1], self.out_size[0]), interpolation=cv2.INTER_AREA)
+        crop_label = cv2.resize(crop_label, (self.out_size[1], self.out_size[0]), interpolation=cv2.INTER_NEAREST)
+        return crop_image, crop_label[..., None]
+
+    def generator(self):
+        # 每次创建迭代器(每个epoch)时重新取随机种子, 各epoch和各并行生成器采到的窗口互不相同
+        rng = np.random.RandomState(np.random.SeedSequence().generate_state(1)[0])
+        while True:
+            yield self.sample(rng)
+
+
+# 从切片直接采样的训练数据源
+def slide_dataset(cfg):
+    """
+    多个生成器并行采样, 输出 uint8 的 (image, label), 尺寸为 cfg.DATASET.RAW_SIZE;
+    每个epoch的样本数为 cfg.DATASET.NUM_TRAIN
+    """
+    sampler = SlideTileSampler(cfg.DATASET.SLIDE_DIR, cfg.DATASET.SLIDE_CSV, cfg.DATASET.SLIDE_CACHE_DIR,
+                               reduce=cfg.DATASET.SLIDE_REDUCE, tile_size=cfg.DATASET.TILE_SIZE,
+                               out_size=cfg.DATASET.RAW_SIZE)
+    size = cfg.DATASET.RAW_SIZE
+    workers = cfg.DATASET.SLIDE_WORKERS
+
+    def _worker(_):
+        return tf.data.Dataset.from_generator(
+            sampler.generator, output_types=(tf.uint8, tf.uint8),
+            output_shapes=([size[0], size[1], cfg.DATASET.CHANNELS], [size[0], size[1], 1]))
+
+    dataset = tf.data.Dataset.range(workers).interleave(_worker, cycle_length=workers,
+                                                        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.take(cfg.DATASET.NUM_TRAIN)
@@ -12,18 +12,22 @@ class_names = ['background', 'Oyster', 'Abalone']
 def config_optimizer(cfg, learning_rate):
     # Adam算法，自适应学习率
     if cfg.TRAIN.OPTIMIZER == "Adam":
-        return tf.keras.optimizers.Adam(learning_rate)
+        optimizer = tf.keras.optimizers.Adam(learning_rate)
     # 梯度下降法
     elif cfg.TRAIN.OPTIMIZER == "sgd":
-        return tf.keras.optimizers.SGD(learning_rate=learning_rate, momentum=cfg.TRAIN.MOMENTUM)
+        optimizer = tf.keras.optimizers.SGD(learning_rate=learning_rate, momentum=cfg.TRAIN.MOMENTUM)
     # RMSProp算法，自适应学习率
     elif cfg.TRAIN.OPTIMIZER == "RMSProp":
-        return tf.keras.optimizers.RMSprop(learning_rate=learning_rate, rho=cfg.TRAIN.RHO, momentum=cfg.TRAIN.MOMENTUM)
-    # 动量优化法,一般动量momentum取0.9
+        optimizer = tf.keras.optimizers.RMSprop(learning_rate=learning_rate, rho=cfg.TRAIN.RHO, momentum=cfg.TRAIN.MOMENTUM)
+    # 动量优化法,一般动量momentum取0.9; 使用 Keras 的 SGD 实现, 与 LossScaleOptimizer 和分布式策略兼容
     elif cfg.TRAIN.OPTIMIZER == "Momentum":
-        return tf.compat.v1.train.MomentumOptimizer(learning_rate=learning_rate, momentum=cfg.TRAIN.MOMENTUM)
+        optimizer = tf.keras.optimizers.SGD(learning_rate=learning_rate, momentum=cfg.TRAIN.MOMENTUM)
     else:
         raise ValueError('Unsupported optimizer type!')
+    # float16 的指数范围小, 需要动态损失缩放防止梯度下溢; bfloat16 与 float32 指数位相同, 不需要
+    if cfg.TRAIN.MIXED_PRECISION == 'mixed_float16':
+        optimizer = tf.keras.mixed_precision.experimental.LossScaleOptimizer(optimizer, loss_scale='dynamic')
+    return optimizer
 # endregion
 
 
@@ -136,6 +140,16 @@ def add_regularization(model, regularizer=tf.keras.regularizers.l2(0.0001)):
     return model
 
 
+# 混合精度策略, 必须在创建模型之前设置
+def set_mixed_precision(cfg):
+    """
+    cfg.TRAIN.MIXED_PRECISION: '' 为 float32; 'mixed_float16' 用于GPU; 'mixed_bfloat16' 用于CPU/TPU
+    """
+    if cfg.TRAIN.MIXED_PRECISION:
+        policy = tf.keras.mixed_precision.experimental.Policy(cfg.TRAIN.MIXED_PRECISION)
+        tf.keras.mixed_precision.experimental.set_policy(policy)
+
+
 # 显卡配置
 def set_device():
     physical_devices = tf.config.experimental.list_physical_devices('GPU')
@@ -143,10 +157,43 @@ def set_device():
         tf.config.experimental.set_memory_growth(physical_devices[0], True)
 
 
+# 分布式策略
+def get_strategy(cfg):
+    """
+    cfg.TRAIN.STRATEGY:
+        '': 单设备
+        'mirrored': 单机多设备同步训练
+        'multi_worker': 多机或单机多进程同步训练, 集群由环境变量 TF_CONFIG 指定, 例如
+            {"cluster": {"worker": ["host1:12345", "host2:12345"]}, "task": {"type": "worker", "index": 0}}
+    """
+    if cfg.TRAIN.STRATEGY == 'mirrored':
+        return tf.distribute.MirroredStrategy()
+    elif cfg.TRAIN.STRATEGY == 'multi_worker':
+        return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    elif not cfg.TRAIN.STRATEGY:
+        return tf.distribute.get_strategy()
+    else:
+        raise ValueError('Unsupported strategy type!')
+
+
+# 是否为负责写日志和保存模型的 worker
+def is_chief(strategy):
+    """
+    TF_CONFIG 中有 'chief' 任务时只有它是 chief, 否则由 worker 0 负责
+    """
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    if resolver is None or not resolver.task_type:
+        return True
+    if resolver.task_type == 'chief':
+        return True
+    return (resolver.task_type == 'worker' and resolver.task_id == 0
+            and 'chief' not in resolver.cluster_spec().as_dict())
+
+
 # checkpoink 配置
-def ckpt_manager(cfg, model, logger, opt):
+def ckpt_manager(cfg, model, logger, opt, directory=None):
     checkpoint = tf.train.Checkpoint(step=tf.Variable(0), optimizer=opt, net=model)
-    manager = tf.train.CheckpointManager(checkpoint, cfg.CKPT_DIR, max_to_keep=3)
+    manager = tf.train.CheckpointManager(checkpoint, directory or cfg.CKPT_DIR, max_to_keep=3)
     # region # 模型保存与恢复
     # checkpoint = tf.train.Checkpoint(myAwesomeModel=model)
     # 使用tf.train.CheckpointManager管理Checkpoint